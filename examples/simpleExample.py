@@ -18,13 +18,13 @@ def simpleExample(imageDir="/Users/csayres/arcsatData/arcsat/GJ1243/gFilter/oneN
     plt.show(block=True)
     photOut.chooseComparisons() # figure 2 will pop up, click as many comparison stars as you like then close
     plt.show(block=True)
-    photOut.crunch()
     outputter = autoPhot.output.Dump(imageDir, photOut)
+    outputter.crunch() # crunch, writing photOut.fits and photOut.npy as each image is done
     outputter.saveDatFile() # saves a data file of photometry values...looks like a date-obs column would be useful
     outputter.saveField() # saves a pic of the finder and target/comparison stars
     fig = plt.figure()
     ax = fig.add_subplot(111)
-    autoPhot.viz.plotDiff(ax, photOut.df)
+    autoPhot.viz.plotDiff(ax, photOut.results)
     plt.show(block=True)
 
 if __name__ == "__main__":
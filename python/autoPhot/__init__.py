@@ -1,7 +1,55 @@
-from config import *
-from flow import *
-from img import *
-from output import *
-from phot import *
-from triangleHash import *
-from viz import *
\ No newline at end of file
+"""autoPhot, submodules are imported on first use, so importing the package (or
+just one submodule, as worker processes do) doesn't pull in matplotlib, pyfits,
+PyGuide etc. unless they're needed.  The public names of each submodule are
+available from the package as before, eg autoPhot.Driver, autoPhot.PhotConfig.
+"""
+import sys
+import types
+import importlib
+
+# public names, by the submodule defining them
+_exports = {
+    'config': ['PhotConfig', 'CameraConst', 'parseDate', 'flareCam', 'Config'],
+    'flow': ['NBRIGHTSTARS', 'CENTROIDRAD', 'TRACKFRACTION', 'Driver', 'Cruncher', 'FieldCruncher',
+        'ForcedCentroid', 'Watcher', 'Fallback', 'CheckpointStore', 'FieldSolution'],
+    'img': ['FITSBLOCK', 'readSections', 'imgShape', 'fitsSize', 'FrameCache', 'Img', 'FrameWindows',
+        'Bias', 'Dark', 'Flat', 'Light', 'ImgCombine', 'zeroCombine', 'flatCombine', 'darkCombine',
+        'MasterCache', 'cameraKey',
+        'Calibrator', 'Prefetcher', 'HeaderManifest', 'readHeaders', 'imgLister',
+        'groupByFilter'],
+    'instrument': ['Instruments', 'NullInstruments'],
+    'output': ['ZEROPOINT', 'Dump', 'RowWriter', 'FitsWriter', 'NpyWriter', 'CsvWriter', 'WRITERS',
+        'fileSafe', 'fitsCard', 'fitsHeader'],
+    'phot': ['PhotObj', 'BatchPhotObj', 'weightedMedian', 'SKYMETHODS', 'SKYCLIP', 'SKYITER', 'skyLevel',
+        'BATCHSIZE', 'ApPhot', 'ExactApPhot', 'cornerArea', 'BACKENDS', 'DiffPhotObj', 'PhotTable'],
+    'triangleHash': ['FieldTransform', 'fitTransform', 'TriangleHash'],
+    'viz': ['apPhotExtraction', 'skyHist', 'countsHist', 'plotDiff', 'plotTarg', 'plotComp',
+        'plotLightCurve', 'showField', 'showFieldSolution', 'renderFallbacks',
+        'renderFallbacksBackground', 'circle', 'scaleImg'],
+}
+_modNames = dict((name, modName) for modName, names in _exports.iteritems() for name in names)
+
+class _LazyPackage(types.ModuleType):
+    """Stands in for this package in sys.modules, importing submodules when one
+    of them, or a name from one, is first asked for
+    """
+    def __getattr__(self, name):
+        if name in _exports:
+            return importlib.import_module('.' + name, __name__)
+        if name in _modNames:
+            value = getattr(importlib.import_module('.' + _modNames[name], __name__), name)
+            setattr(self, name, value) # only look it up once
+            return value
+        raise AttributeError("module '%s' has no attribute '%s'" % (__name__, name))
+
+    def __dir__(self):
+        return sorted(set(self.__dict__) | set(_exports) | set(_modNames))
+
+__all__ = sorted(_modNames)
+
+_package = _LazyPackage(__name__, __doc__)
+_package.__dict__.update(dict((key, value) for key, value in globals().iteritems()
+    if key.startswith('__')))
+# keep the original module alive, python 2 clears a module's globals when it is collected
+_package._original = sys.modules[__name__]
+sys.modules[__name__] = _package
@@ -3,6 +3,7 @@
 import datetime
 import numpy
 import img
+import phot
 import PyGuide
 
 class PhotConfig(object):
@@ -11,17 +12,28 @@ class PhotConfig(object):
     includes defaults for photometry
     """
     def __init__(self,           
-            inrad = 2, # pixels
+            inrad = 2, # pixels, or a list of radii to measure each star in all of
+            # them at once (a curve of growth), counts then get a radius axis
             skyann = [6, 8], # pixels
             res=21, # must be odd
             spline=0, # should probably remain 0.  Higher orders seem to
             # introduce some structure (aliasing?) into the signal
             # more experimentation is probably merited.
+            backend='dense', # 'dense': partial pixels by upsampling by res
+            # 'exact': exact pixel/aperture overlap, res and spline are not used
+            skyMethod='median', # sky estimator, 'median', 'sigclip' (clipped mean)
+            # or 'mode', see phot.skyLevel
         ):
+        if backend not in phot.BACKENDS:
+            raise RuntimeError('backend must be one of %s, got %s' % (phot.BACKENDS.keys(), backend))
+        if skyMethod not in phot.SKYMETHODS:
+            raise RuntimeError('skyMethod must be one of %s, got %s' % (phot.SKYMETHODS, skyMethod))
         self.inrad = inrad
         self.skyann = skyann
         self.res = res
         self.spline = spline
+        self.backend = backend
+        self.skyMethod = skyMethod
 
 class CameraConst(object):
     """A dictionary for storing camera attributes
@@ -77,28 +89,87 @@ flareCam.parseDate = parseDate
 class Config(object):
     """object containing all the necessary parameters for photometry, etc
     """
-    def __init__(self, camera, phot, objFileList, biasFileList = None, flatFileList = None):
+    def __init__(self, camera, phot, objFileList, biasFileList = None, flatFileList = None, 
+            cacheBytes = None, frameAccess = 'full', calCacheDir = None, manifestPath = None,
+            prefetch = 0, headless = False, keepDiagnostics = False, checkpointPath = None,
+            darkFileList = None, overscan = None, trim = None, calDtype = numpy.float32):
         """Inputs:
         camera: a CameraConst object
         phot: a PhotConfig object
-        objFileList = list of files to process
+        objFileList = list of files to process, they may be of several filters, 
+            split into objByFilter (see flow.Driver.crunchFilters)
         biasFileList = list of bias image files or None
         flatFileList = list of flat image files or None
+        cacheBytes = memory budget (bytes) for keeping calibrated object frames around
+            so they aren't reread, or None for no caching
+        frameAccess = 'full' to read whole object frames, or 'window' to memory map
+            them and only read (and calibrate) windows around the target and 
+            comparisons.  Whole frames are still read when a frame needs hashing.
+        calCacheDir = directory to keep master bias and flat frames in between runs, 
+            or None to combine them every time
+        manifestPath = file to remember image header values in between runs, so only 
+            new or changed files have their headers read, or None
+        prefetch = number of object frames to read and calibrate ahead in background
+            threads while photometry is done, 0 for none.  Only used with 
+            frameAccess 'full'
+        headless = if True never plot while crunching, hash fallbacks are recorded 
+            in Driver.fallbacks instead
+        keepDiagnostics = if True keep every image's phot.DiffPhotObj (with the image, 
+            photometry details and per star phot.PhotObjs for viz) in Driver.df, 
+            otherwise only the Driver.results table is kept
+        checkpointPath = file to remember each image's photometry in, so a rerun 
+            (eg after a crash, or once more images arrive) skips images already 
+            measured with the same phot config and stars, or None
+        darkFileList = list of dark image files (all of one exposure time) or None.
+            The dark current is scaled to each object frame's exposure time
+        overscan = (row slice, column slice) of the raw frames holding overscan 
+            pixels, whose median is subtracted from each frame, or None
+        trim = (row slice, column slice) of the raw frames to keep, or None.  Image 
+            coordinates (eg the target and comparison positions) are of the 
+            trimmed frames
+        calDtype = numpy dtype calibrated frames are kept in
         """
+        if frameAccess not in ['full', 'window']:
+            raise RuntimeError('frameAccess must be "full" or "window", got %s' % frameAccess)
         self.camera = camera
         self.phot = phot  
+        self.frameAccess = frameAccess
+        self.prefetch = prefetch
+        self.headless = headless
+        self.keepDiagnostics = keepDiagnostics
+        self.checkpointPath = checkpointPath
+        manifest = img.HeaderManifest(manifestPath) if manifestPath else None
         calibrator = None
         if biasFileList and flatFileList:
             biasList = img.imgLister(biasFileList, type = 'bias', 
-                                        cameraConst = camera, calibrator = None)
+                                        cameraConst = camera, calibrator = None,
+                                        manifest = manifest)
             flatList = img.imgLister(flatFileList, type = 'flat', 
-                                cameraConst = camera, calibrator = None)
-            calibrator = img.Calibrator(biasList, flatList) # removes bias from flats
+                                cameraConst = camera, calibrator = None, 
+                                manifest = manifest)
+            darkList = None
+            if darkFileList:
+                darkList = img.imgLister(darkFileList, type = 'dark', 
+                                    cameraConst = camera, calibrator = None, 
+                                    manifest = manifest)
+            masterCache = img.MasterCache(calCacheDir) if calCacheDir else None
+            calibrator = img.Calibrator(biasList, flatList, masterCache = masterCache,
+                                cameraConst = camera, darkList = darkList, dtype = calDtype,
+                                overscan = overscan, trim = trim) # removes bias from flats
         else:
             print 'no calibration frames reveived!, proceeding'
         self.calibrator = calibrator
+        self.frameCache = img.FrameCache(cacheBytes) if cacheBytes else None
         self.objList = img.imgLister(objFileList, type = 'light', 
-                            cameraConst = camera, calibrator = calibrator)
+                            cameraConst = camera, calibrator = calibrator, 
+                            cache = self.frameCache, manifest = manifest)
+        # the same images split by filter, each is flat fielded with its own
+        # filter's master flat
+        self.objByFilter = img.groupByFilter(self.objList)
+        if calibrator and calibrator.flat:
+            for filter in self.objByFilter:
+                if filter not in calibrator.flat:
+                    print 'warning: no flats for filter %s, its images will not be flat fielded' % filter
         self.ccdInfo = PyGuide.CCDInfo(0, camera.readNoise, camera.ccdGain)    
           
 #FlareCamConfig = 
\ No newline at end of file
@@ -7,17 +7,22 @@ note: add warning if comparison == target
 note: to deal with shift during exposure, grab oldest field solution
 """
 
-import pyfits
 import numpy
 import datetime
 import glob
-import matplotlib.pyplot as plt
-plt.ion()
-import matplotlib.dates
+import os
+import sys
+import json
+import hashlib
+import time
+import threading
+import collections
 import PyGuide
 import copy
+import multiprocessing
 import phot
 import img
+import instrument
 #from camera import flareCam
 #from config import flareCamConfig
 import viz
@@ -25,6 +30,8 @@ import viz
 from triangleHash import *
 
 NBRIGHTSTARS = 20
+CENTROIDRAD = 3 # pixels, PyGuide centroid search radius
+TRACKFRACTION = 0.5 # full field mode hashes when fewer of the tracked stars are found
 
 class Driver(object):
     """Drives the reduction process, keeps track of what's going on and what's next
@@ -37,12 +44,91 @@ class Driver(object):
         self.config = config
         self.fieldSolution = FieldSolution() # initialize empty
         self.cruncher = None # set by crunch method
-        self.df = None # set by crunch method
-        self.cruncher = Cruncher(self.fieldSolution, self.config.ccdInfo)
-        self.cruncher.centroid = self.centroid
+        self.results = None # phot.PhotTable, set by crunch method
+        self.df = None # list of DiffPhotObjs, set by crunch method if config.keepDiagnostics
+            # ({filter: list} after crunchFilters)
+        self.filterResults = None # {filter: phot.PhotTable}, set by crunchFilters
+        self.cruncher = Cruncher(self.fieldSolution, self.config.ccdInfo, 
+            headless = self.config.headless)
 
-    def crunch(self):
-        self.df = self.cruncher.crunchLoop(self.config.objList, self.config)
+    @property
+    def fallbacks(self):
+        """list of Fallback diagnostics from the last crunch
+        """
+        return self.cruncher.fallbacks
+
+    @property
+    def instruments(self):
+        """instrument.Instruments with stage timings and counters from crunching
+        """
+        return self.cruncher.instruments
+
+    def crunch(self, nProc=1, writers=None):
+        """nProc: number of processes to crunch with, see Cruncher.crunchLoop
+        writers: list of output.RowWriters to stream results to, see output.Dump.crunch
+        """
+        self.results = self.cruncher.crunchLoop(self.config.objList, self.config, nProc=nProc,
+            writers=writers)
+        if self.config.keepDiagnostics:
+            self.df = self.cruncher.diffPhotObjs
+
+    def crunchFilters(self, nProc=1, writers=None):
+        """Crunch each filter's images (config.objByFilter) as its own pipeline, all
+        filters at once in separate threads, so a night in several bands takes 
+        about as long as its slowest band.  Every filter is measured against the
+        same field solution.  Results go to self.filterResults, a phot.PhotTable
+        per filter; fallbacks and instruments are gathered into the driver's.  
+        A single filter is crunched in the calling thread, with more than one 
+        nothing is plotted while crunching (matplotlib only draws from the main 
+        thread).  If any filter fails the others still finish, then the first 
+        failure is raised again with its own traceback.
+        nProc: number of processes each filter is crunched with, see Cruncher.crunchLoop
+        writers: {filter: list of output.RowWriters}, see output.Dump.crunchFilters
+        """
+        writers = writers or {}
+        groups = self.config.objByFilter
+        headless = self.config.headless or len(groups) > 1
+        crunchers = dict((filter, self.cruncher.__class__(self.fieldSolution, self.config.ccdInfo, 
+            headless = headless)) for filter in groups)
+        results = {}
+        errors = []
+        def crunchFilter(filter):
+            try:
+                results[filter] = crunchers[filter].crunchLoop(groups[filter], self.config, 
+                    nProc = nProc, writers = writers.get(filter))
+            except Exception:
+                errors.append((filter, sys.exc_info()))
+        with self.instruments.stage('crunchFilters'):
+            if len(groups) == 1:
+                crunchFilter(groups.keys()[0])
+            else:
+                threads = [threading.Thread(target = crunchFilter, args = (filter,), 
+                    name = 'crunch %s' % filter) for filter in groups]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+        for filter in groups:
+            cruncher = crunchers[filter]
+            self.fallbacks.extend(cruncher.fallbacks)
+            self.instruments.merge(cruncher.instruments)
+        if errors:
+            for filter, excInfo in errors:
+                print 'crunching filter %s failed: %r' % (filter, excInfo[1])
+            excType, excValue, excTraceback = errors[0][1]
+            raise excType, excValue, excTraceback
+        self.filterResults = collections.OrderedDict((filter, results[filter]) for filter in groups)
+        if self.config.keepDiagnostics:
+            self.df = dict((filter, crunchers[filter].diffPhotObjs) for filter in groups)
+
+    def watch(self, watchDir, pattern = '*', callback = None, pollInterval = 0.1, **kwargs):
+        """Measure new images as they're written to watchDir, see Watcher.  Runs until
+        interrupted (or see Watcher.run for kwargs).  The target and comparisons
+        must already be chosen.
+        """
+        watcher = Watcher(self, watchDir, pattern, callback, pollInterval)
+        watcher.run(**kwargs)
+        return watcher
 
     def chooseTarget(self, imgNum = 0):
         """Select the target star
@@ -61,6 +147,8 @@ class Driver(object):
 
         self.fieldSolution.img = img
         self.fieldSolution.hash = TriangleHash(self.cruncher.findSources(img.data))
+        import matplotlib.pyplot as plt
+        plt.ion()
         fig = plt.figure()
         ax = fig.add_subplot(111)
         viz.showFieldSolution(ax, self.fieldSolution)
@@ -85,6 +173,8 @@ class Driver(object):
             #self.fieldSolution.compCoords = compCoords if compCoords else None
 
         self.fieldSolution.img = self.config.objList[imgNum]
+        import matplotlib.pyplot as plt
+        plt.ion()
         fig = plt.figure()
         ax = fig.add_subplot(111)
         viz.showFieldSolution(ax, self.fieldSolution)
@@ -93,31 +183,79 @@ class Driver(object):
         #plt.show()
         #self.fieldSolution.compCoords = compCoords if compCoords else None
 
+    def chooseField(self, imgNum = 0, nStars = None):
+        """Full field photometry: catalog every star found in image imgNum and 
+        measure all of them in every image (see FieldCruncher), instead of a 
+        chosen target and comparisons.  The brightest star takes the target's 
+        place, the rest the comparisons'.
+        nStars: keep only this many of the brightest stars, None for all
+        """
+        img = self.config.objList[imgNum]
+        catalog = self.cruncher.findSources(img.data, nStars = nStars)
+        if not len(catalog):
+            raise RuntimeError('no stars found in %s' % img.path)
+        self.fieldSolution.img = img
+        self.fieldSolution.hash = TriangleHash(catalog[:NBRIGHTSTARS])
+        self.fieldSolution.targetCoords = catalog[0]
+        self.fieldSolution.compCoords = list(catalog[1:])
+        self.cruncher = FieldCruncher(self.fieldSolution, self.config.ccdInfo, 
+            headless = self.config.headless)
+        print 'cataloged %i stars' % len(catalog)
+
     def centroid(self, xyPos, data):
         """check to see if there is valid signal at xpos, ypos, on image data
         if so return the centroid.
         """
-        # default to 5 px search rad?
-        return PyGuide.centroid(data, None, None, xyPos, rad = 3, #pixels
-            ccdInfo = self.config.ccdInfo)
+        return self.cruncher.centroid(xyPos, data)
 
 class Cruncher(object):
     """This does all the work, applying calibrations, finding stars, doing photometry...
     """
-    def __init__(self, fieldSolution, ccd):
+    refinesTransform = False # the transform changes only when the field is hashed
+
+    def __init__(self, fieldSolution, ccd, headless=False):
         """Inputs:
         fieldSolution: a FieldSolution object, which contains a triangleHash and locations for
             target and comparison stars. Will get updated upon iterations
         imgList: a list of img.Light objects for photometry extraction
         ccd: a PyGuide ccd constant object
+        headless: if True never plot, hash fallbacks are only recorded in self.fallbacks
+            (see viz.renderFallbacks to draw them later)
         """
         self.fieldSolution = fieldSolution
         self.ccd = ccd
+        self.headless = headless
+        self.fallbacks = [] # a Fallback for every image that needed hashing
+        self.diffPhotObjs = [] # kept only if config.keepDiagnostics
+        self.instruments = instrument.Instruments() # stage timers and counters
+
+    def centroid(self, xyPos, data):
+        """check to see if there is valid signal at xpos, ypos, on image data
+        if so return the centroid.
+        """
+        # default to 5 px search rad?
+        return PyGuide.centroid(data, None, None, xyPos, rad = CENTROIDRAD,
+            ccdInfo = self.ccd)
 
-    def centroid(self, xyPOs, data):
-        """Added by the Driver,
+    def windowCentroid(self, xyPos, frameWindows, ind):
+        """centroid within one window of an img.FrameWindows, xyPos and the 
+        returned centroid are in full image coordinates
         """
-        raise NotImplementedError
+        origin = frameWindows.origins[ind]
+        cent = self.centroid(numpy.asarray(xyPos) - origin, frameWindows.windows[ind])
+        if cent.isOK:
+            cent.xyCtr = tuple(numpy.asarray(cent.xyCtr) + origin)
+        return cent
+
+    def windowHalfSize(self, config):
+        """half width of windows read around each star when config.frameAccess is
+        'window', big enough to centroid and hold the photometry region around 
+        wherever the centroid lands
+        """
+        boxSize = config.phot.skyann[1]
+        if boxSize % 2 == 0:
+            boxSize += 1 # as phot.ApPhot does
+        return boxSize + CENTROIDRAD + 2
 
     def inImgBound(self, coord, imgData):
         """Check that coord (xyPos) lies within the image bounds.
@@ -127,90 +265,243 @@ class Cruncher(object):
         coord = coord - 0.5
         return True if numpy.zeros(2) <= coord <= coord.shape else False
 
-    def crunchPhot(self, img, offset, config):
-#     def crunchPhot(self, img, config):
+    def crunchPhot(self, img, transform, config, imgData=None):
         """Do photometery for a single image
-        returns a diffPhot Obj and an updated fieldSolution
+        transform: triangleHash.FieldTransform from the reference image to this one
+            (the last image's is a good guess)
+        imgData: img.data if it's already been read, or None
+        returns a diffPhot Obj, the (possibly updated) transform and phot.PhotTable flags
         returns None if there was some problem
         """
-        imgData = img.data
+        flags = 0
+        targPos = transform.apply(self.fieldSolution.targetCoords)
+        compPos = list(transform.apply(self.fieldSolution.compCoords))
         # check to see if all centroids are found in new image
-        targCent = self.centroid(numpy.asarray(self.fieldSolution.targetCoords) - offset, imgData)
-        compCent = [self.centroid(numpy.asarray(comp) - offset, imgData) for comp in self.fieldSolution.compCoords]
+        instruments = self.instruments
+        if config.frameAccess == 'window' and imgData is None:
+            # only read the pixels around each star, target window first
+            photData = img.readWindows([targPos] + compPos, self.windowHalfSize(config), instruments)
+            with instruments.stage('centroid'):
+                targCent = self.windowCentroid(targPos, photData, 0)
+                compCent = [self.windowCentroid(pos, photData, ind + 1) for ind, pos in enumerate(compPos)]
+        else:
+            if imgData is None:
+                imgData = img.getData(instruments)
+            photData = imgData
+            with instruments.stage('centroid'):
+                targCent = self.centroid(targPos, photData)
+                compCent = [self.centroid(pos, photData) for pos in compPos]
         allCents =  compCent[:]
         allCents.append(targCent)
         if False in [cent.isOK for cent in allCents]:
-            # one or more centroids failed, try to hash for an offset
-            newSources = self.findSources(imgData)
-            # overwrite the old offset
-#            offset = numpy.asarray(self.fieldSolution.hash.hashItOut(newSources))
+            # one or more centroids failed, try to hash for a new transform
+            # this needs the whole image
+            instruments.count('centroidsFailed', [cent.isOK for cent in allCents].count(False))
+            instruments.count('hashed')
+            if imgData is None:
+                imgData = img.getData(instruments)
+            photData = imgData
+            with instruments.stage('findSources'):
+                newSources = self.findSources(imgData)
+            # overwrite the old transform
             try:
-                offset = numpy.asarray(self.fieldSolution.hash.hashItOut(newSources))
+                with instruments.stage('hash'):
+                    transform = self.fieldSolution.hash.hashItOut(newSources)
             except Exception as e:
-                print 'offset failed with exception %s'%e
+                print 'transform failed with exception %s'%e
+                instruments.count('hashFailed')
+                self.fallbacks.append(Fallback(img, None, targPos, compPos))
                 return None
-            print 'new offset: ', offset
-            targCent = self.centroid(self.fieldSolution.targetCoords - offset, imgData)
-            compCent = [self.centroid(comp - offset, imgData) for comp in self.fieldSolution.compCoords]
-            fig = plt.gcf()
-            #fig = plt.figure()
-            ax = fig.add_subplot(111)
-            viz.showField(ax, imgData, self.fieldSolution.targetCoords - offset, [comp - offset for comp in self.fieldSolution.compCoords])
-            plt.show(block=False)
+            print 'new transform: ', transform
+            flags |= phot.PhotTable.FLAG_HASHED
+            targPos = transform.apply(self.fieldSolution.targetCoords)
+            compPos = list(transform.apply(self.fieldSolution.compCoords))
+            with instruments.stage('centroid'):
+                targCent = self.centroid(targPos, imgData)
+                compCent = [self.centroid(pos, imgData) for pos in compPos]
+            self.fallbacks.append(Fallback(img, transform, targPos, compPos, 
+                targCent.isOK, [comp.isOK for comp in compCent]))
+            if not self.headless:
+                instruments.count('plotted')
+                import matplotlib.pyplot as plt
+                fig = plt.gcf()
+                #fig = plt.figure()
+                ax = fig.add_subplot(111)
+                viz.showField(ax, imgData, targPos, compPos)
+                plt.show(block=False)
             if not targCent.isOK:
                 print "couldn't find target in image: %s" % img.path
                 return None
             if False in [comp.isOK for comp in compCent]:
                 print "warning: one or more comparison stars not found in image: %s" % img.path
                 return None
-            # target was found, keep the offset and run with it
+            # target was found, keep the transform and run with it
         try:
-            df = phot.DiffPhotObj(
-                img = img, targCentroid = targCent,
-                compCentroids = compCent, inrad = config.phot.inrad, skyAnnulus = config.phot.skyann,
-                resolution = config.phot.res, spline = config.phot.spline
-                )
-            return df, offset
+            with instruments.stage('photometry'):
+                df = phot.DiffPhotObj(
+                    img = img, targCentroid = targCent,
+                    compCentroids = compCent, inrad = config.phot.inrad, skyAnnulus = config.phot.skyann,
+                    resolution = config.phot.res, spline = config.phot.spline,
+                    backend = config.phot.backend, data = photData, 
+                    skyMethod = config.phot.skyMethod, keepPhotObjs = config.keepDiagnostics,
+                    )
+            return df, transform, flags
         except Exception as e:
             print 'Could not compute photometry, exception: %s' %e
             return None
 
-    def crunchLoop(self, imgList, config):
-        """begin the crunching, build a list of DiffPhot objects
+    def crunchLoop(self, imgList, config, nProc=1, writers=None):
+        """begin the crunching, returns a phot.PhotTable with a row for each image
+        photometry was extracted from
+
+        nProc: number of processes to use.  With more than one the time ordered imgList
+            is split into nProc chunks crunched in a process pool.  Every chunk starts 
+            with no offset (or its first image's checkpointed transform), as the serial 
+            loop does, and only hashes when centroiding fails.  A chunk that the serial 
+            loop would have entered with some other transform, because the field was 
+            hashed before it, is crunched again from that transform, so the output is 
+            the same as a serial crunch (FieldCruncher, whose transform changes every 
+            image, keeps its chunks as they are).
+        writers: list of output.RowWriters, each image's row is written as soon as 
+            it's measured (or as soon as its chunk, and all chunks before it, are)
+        """
+        writers = writers or []
+        nChunks = min(nProc, len(imgList))
+        if nChunks <= 1:
+            with self.instruments.stage('crunchLoop'):
+                return self.crunchChunk(imgList, config, transform = FieldTransform(), 
+                    writers = writers)
+        checkpoint = CheckpointStore(config.checkpointPath) if config.checkpointPath else None
+        if checkpoint:
+            keys = dict((image.path, checkpoint.fingerprint(image, config, self.fieldSolution)) 
+                for image in imgList)
+        chunkEdges = numpy.linspace(0, len(imgList), nChunks + 1).astype(int)
+        chunks = []
+        for start, end in zip(chunkEdges[:-1], chunkEdges[1:]):
+            row = checkpoint.get(keys[imgList[start].path]) if checkpoint else None
+            transform = FieldTransform() if row is None else CheckpointStore.transform(row)
+            chunks.append((start, end, transform, row is not None))
+        with self.instruments.stage('crunchLoop'):
+            # everything the chunks share (the images, their calibrator's master 
+            # frames, the config) is handed to each worker once as it starts, 
+            # chunks only carry their image range
+            pool = multiprocessing.Pool(nChunks, _initCrunchWorker, 
+                (self.__class__, self.fieldSolution, self.ccd, imgList, config))
+            try:
+                # chunks come back in order, as they finish
+                chunkOut = pool.imap(_crunchChunk, [chunk[:3] for chunk in chunks])
+                photTable = phot.PhotTable(self._nStars(), len(imgList), config.phot.inrad)
+                carried = FieldTransform() # what the serial loop would start the next chunk with
+                for (start, end, transform, checkpointed), out in zip(chunks, chunkOut):
+                    chunkTable, fallbacks, dfs, instruments = out
+                    if not (checkpointed or self.refinesTransform or sameTransform(carried, transform)):
+                        # measured from the wrong transform, redo it here from the right one
+                        self.instruments.count('chunksRedone')
+                        chunkTable = self.crunchChunk(imgList[start:end], config, carried)
+                    else:
+                        if checkpoint:
+                            with self.instruments.stage('checkpoint'):
+                                for ind in range(len(chunkTable)):
+                                    key = keys[chunkTable.path[ind]]
+                                    if checkpoint.get(key) is None:
+                                        checkpoint.put(key, chunkTable.row(ind))
+                        self.fallbacks.extend(fallbacks)
+                        self.diffPhotObjs.extend(dfs)
+                        self.instruments.merge(instruments)
+                    if len(chunkTable):
+                        carried = CheckpointStore.transform(chunkTable.row(len(chunkTable) - 1))
+                    start = len(photTable)
+                    photTable.extend(chunkTable)
+                    with self.instruments.stage('write'):
+                        for writer in writers:
+                            writer.write(photTable, start, len(photTable))
+            finally:
+                pool.close()
+                pool.join()
+        return photTable
+
+    def _nStars(self):
+        """number of stars measured, target plus comparisons
+        """
+        return 1 + len(self.fieldSolution.compCoords)
 
-        should be parrallelizable
+    def crunchChunk(self, imgList, config, transform=None, writers=None, checkpointRows=True):
+        """crunch imgList serially, carrying the field transform from one image to the next.
+        transform: FieldTransform to start with, if None the first image's checkpointed 
+            transform, or no offset
+        writers: list of output.RowWriters to write each row to as it's measured
+        checkpointRows: if False rows already in config.checkpointPath are used but new
+            ones aren't stored (crunchLoop's workers, their rows may be thrown away)
+        returns a phot.PhotTable, DiffPhotObjs are added to self.diffPhotObjs if 
+            config.keepDiagnostics
         """
-        # not sure if this is necessary, rationale is for parallel loops
-        # each with their own independent fieldSolution
-        #fieldSolution = copy.copy(self.fieldSolution)
-        dfList = []
-        offset = numpy.array([0,0]) # begin with no offset
+        writers = writers or []
+        checkpoint = CheckpointStore(config.checkpointPath) if config.checkpointPath else None
+        # rows of images already measured with the same fingerprint, else None
+        if checkpoint:
+            keys = [checkpoint.fingerprint(image, config, self.fieldSolution) for image in imgList]
+            doneRows = [checkpoint.get(key) for key in keys]
+            print '%i of %i images already measured' % (len(doneRows) - doneRows.count(None), len(doneRows))
+        else:
+            keys = doneRows = [None] * len(imgList)
+        if transform is None:
+            if doneRows[0] is not None:
+                transform = CheckpointStore.transform(doneRows[0])
+            else:
+                transform = FieldTransform()
+        todo = [image for image, row in zip(imgList, doneRows) if row is None]
+        instruments = self.instruments
+        if config.prefetch and config.frameAccess == 'full':
+            # read and calibrate upcoming images in the background
+            imgIter = iter(img.Prefetcher(todo, config.prefetch, instruments = instruments))
+        else:
+            imgIter = ((image, None) for image in todo)
+        photTable = phot.PhotTable(self._nStars(), len(imgList), config.phot.inrad)
         imNum = 1
-        for img in imgList:
+        for key, row in zip(keys, doneRows):
             print 'image Number: ', imNum
             imNum += 1
-            out = self.crunchPhot(img, offset, config)
-            #out = self.crunchPhot(img, config)
-            if not out:
-                # photometry returned None, skip that image
-                # try again using original field solution
-                print 'image extraction failed %s, skipping' % img.path
-                continue
-            # update offset
-            # append the diffPhotObj to the list
-            df, offset = out
-            dfList.append(df)
-        return dfList
+            instruments.count('frames')
+            if row is not None:
+                # measured in an earlier run, carry on from its transform
+                instruments.count('checkpointed')
+                photTable.appendRow(row)
+                transform = CheckpointStore.transform(row)
+            else:
+                with instruments.frame(None) as frameRecord:
+                    image, imgData = next(imgIter)
+                    frameRecord['path'] = image.path
+                    out = self.crunchPhot(image, transform, config, imgData)
+                    if not out:
+                        # photometry returned None, skip that image
+                        # try again using original field solution
+                        print 'image extraction failed %s, skipping' % image.path
+                        instruments.count('dropped')
+                        continue
+                    # update transform
+                    # add a row to the table
+                    df, transform, flags = out
+                    photTable.append(df, transform, flags)
+                    if checkpoint and checkpointRows:
+                        with instruments.stage('checkpoint'):
+                            checkpoint.put(key, photTable.row(len(photTable) - 1))
+                    if config.keepDiagnostics:
+                        self.diffPhotObjs.append(df)
+            with instruments.stage('write'):
+                for writer in writers:
+                    writer.write(photTable, len(photTable) - 1, len(photTable))
+        return photTable
 
-    def findSources(self, imgData):
-        """get a list of automatically detected sources
+    def findSources(self, imgData, nStars = NBRIGHTSTARS):
+        """get a list of automatically detected sources, brightest first
+        nStars: keep only this many of the brightest, None for all
         """
         # Set up Hash Table for the 1st image (which all others will be compared to)
         refCoords, stats = PyGuide.findStars(imgData, None, None, self.ccd)
         #refCoords = numpy.asarray(refCoords) - 0.5 # origin is offset by half a pixel width
         # extract xy centers and just keep the NBRIGHTSTARS
-        num = min(len(refCoords), NBRIGHTSTARS)
-        refCoords = numpy.asarray([refCoords[j].xyCtr for j in range(num)])
+        num = len(refCoords) if nStars is None else min(len(refCoords), nStars)
+        refCoords = numpy.asarray([refCoords[j].xyCtr for j in range(num)]).reshape(-1, 2)
         return refCoords
 
     def computeOffset(self, imgData):
@@ -219,6 +510,329 @@ class Cruncher(object):
         coordList = self.findSources(imgData)
         self.fieldSolution.hash.hashItOut(coordList)
 
+class FieldCruncher(Cruncher):
+    """Full field photometry (see Driver.chooseField): every star of the field 
+    solution is measured in every image.  Only the NBRIGHTSTARS brightest are 
+    centroided, to follow the field, the rest are measured where the refined 
+    transform puts them, all in one batch.
+    """
+    refinesTransform = True # the transform follows the tracked stars every image
+
+    def crunchPhot(self, img, transform, config, imgData=None):
+        """Do photometry of every star for a single image, as Cruncher.crunchPhot.
+        The field is hashed only if fewer than TRACKFRACTION of the tracked stars 
+        are found.
+        """
+        flags = 0
+        catalog = numpy.vstack([self.fieldSolution.targetCoords, self.fieldSolution.compCoords])
+        nTrack = min(NBRIGHTSTARS, len(catalog))
+        positions = transform.apply(catalog)
+        instruments = self.instruments
+        if config.frameAccess == 'window' and imgData is None:
+            # windows around every star, in catalog order
+            photData = img.readWindows(positions, self.windowHalfSize(config), instruments)
+            with instruments.stage('centroid'):
+                cents = [self.windowCentroid(pos, photData, ind) for ind, pos in enumerate(positions[:nTrack])]
+        else:
+            if imgData is None:
+                imgData = img.getData(instruments)
+            photData = imgData
+            with instruments.stage('centroid'):
+                cents = [self.centroid(pos, photData) for pos in positions[:nTrack]]
+        found = numpy.asarray([cent.isOK for cent in cents])
+        if found.sum() < TRACKFRACTION * nTrack:
+            # the field moved, hash for a new transform, this needs the whole image
+            instruments.count('centroidsFailed', int(nTrack - found.sum()))
+            instruments.count('hashed')
+            if imgData is None:
+                imgData = img.getData(instruments)
+            photData = imgData
+            with instruments.stage('findSources'):
+                newSources = self.findSources(imgData)
+            try:
+                with instruments.stage('hash'):
+                    transform = self.fieldSolution.hash.hashItOut(newSources)
+            except Exception as e:
+                print 'transform failed with exception %s'%e
+                instruments.count('hashFailed')
+                self.fallbacks.append(Fallback(img, None, positions[0], positions[1:nTrack]))
+                return None
+            print 'new transform: ', transform
+            flags |= phot.PhotTable.FLAG_HASHED
+            positions = transform.apply(catalog)
+            with instruments.stage('centroid'):
+                cents = [self.centroid(pos, imgData) for pos in positions[:nTrack]]
+            found = numpy.asarray([cent.isOK for cent in cents])
+            self.fallbacks.append(Fallback(img, transform, positions[0], positions[1:nTrack],
+                found[0], list(found[1:])))
+            if found.sum() < TRACKFRACTION * nTrack:
+                print "couldn't track the field in image: %s" % img.path
+                return None
+        # refine the transform with the median shift of the tracked stars
+        shift = numpy.median(numpy.asarray([cent.xyCtr for cent in cents if cent.isOK]) - 
+            positions[:nTrack][found], axis=0)
+        transform = FieldTransform(transform.rotation, transform.translation + shift)
+        positions = positions + shift
+        try:
+            with instruments.stage('photometry'):
+                df = phot.DiffPhotObj(
+                    img = img, targCentroid = ForcedCentroid(positions[0]),
+                    compCentroids = [ForcedCentroid(pos) for pos in positions[1:]], 
+                    inrad = config.phot.inrad, skyAnnulus = config.phot.skyann,
+                    resolution = config.phot.res, spline = config.phot.spline,
+                    backend = config.phot.backend, data = photData, 
+                    skyMethod = config.phot.skyMethod, keepPhotObjs = config.keepDiagnostics,
+                    )
+            return df, transform, flags
+        except Exception as e:
+            print 'Could not compute photometry, exception: %s' %e
+            return None
+
+class ForcedCentroid(object):
+    """Stands in for a PyGuide centroid where photometry is forced at a position 
+    known from the field transform, not centroided
+    """
+    def __init__(self, xyCtr):
+        self.xyCtr = tuple(xyCtr)
+        self.isOK = True
+
+class Watcher(object):
+    """Live photometry: polls a directory for new images, and measures each one 
+    once as soon as it's completely written, adding a row to the driver's results.
+    The field transform is carried from one image to the next, so the field is 
+    only hashed when it moves.
+    """
+    def __init__(self, driver, watchDir, pattern = '*', callback = None, pollInterval = 0.1,
+            maxTries = 3):
+        """inputs:
+        driver: a Driver with target and comparisons chosen
+        watchDir: directory the camera writes images to
+        pattern: glob pattern for images in watchDir, eg '*.FIT'
+        callback: called as callback(photTable, row) after each new row, or None
+        pollInterval: seconds between looks at watchDir.  A file is measured once its
+            size is the same in two polls and at least the size its header says it
+            will be (img.fitsSize), so the latency from the camera closing a file to 
+            its row is about pollInterval plus the time to measure it.
+        maxTries: a file that can't be read is tried again at later polls, and 
+            dropped after this many failures
+        """
+        self.driver = driver
+        self.watchDir = watchDir
+        self.pattern = pattern
+        self.callback = callback
+        self.pollInterval = pollInterval
+        self.transform = FieldTransform()
+        self.seen = set(os.path.abspath(image.path) for image in driver.config.objList)
+        self.sizes = {} # path: size when last polled, for files still being written
+        self.failures = {} # path: number of failed reads, for files being retried
+        self.maxTries = maxTries
+        self.stopEvent = threading.Event()
+        if driver.results is None:
+            driver.results = phot.PhotTable(1 + len(driver.fieldSolution.compCoords), 
+                radii = driver.config.phot.inrad)
+        if len(driver.results):
+            self.transform = CheckpointStore.transform(driver.results.row(len(driver.results) - 1))
+
+    def poll(self):
+        """return paths of new files that have finished being written, oldest first
+        """
+        ready = []
+        for path in glob.glob(os.path.join(self.watchDir, self.pattern)):
+            path = os.path.abspath(path)
+            if path in self.seen:
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue # gone already
+            if stat.st_size and self.sizes.get(path) == stat.st_size and self._complete(path, stat.st_size):
+                ready.append((stat.st_mtime, path))
+            self.sizes[path] = stat.st_size
+        return [path for mtime, path in sorted(ready)]
+
+    def _complete(self, path, size):
+        """True if path is at least as big as its header says it will be
+        """
+        try:
+            fullSize = img.fitsSize(path)
+        except (IOError, KeyError, ValueError):
+            return False # gone, or a header card isn't written yet
+        return fullSize is not None and size >= fullSize
+
+    def measure(self, path):
+        """measure one new image, returns True if a row was added.  An image that 
+        can't be read is left to be tried again (see maxTries)
+        """
+        config = self.driver.config
+        instruments = self.driver.instruments
+        try:
+            image, = img.imgLister([path], type = 'light', cameraConst = config.camera,
+                calibrator = config.calibrator, cache = config.frameCache)
+            with instruments.frame(path):
+                out = self.driver.cruncher.crunchPhot(image, self.transform, config)
+        except Exception as e:
+            print 'could not read %s, exception: %s' % (path, e)
+            self.failures[path] = self.failures.get(path, 0) + 1
+            if self.failures[path] < self.maxTries:
+                return False # its size is kept, so it's ready again at the next poll
+            print 'giving up on %s after %i tries' % (path, self.failures[path])
+            out = None
+        self.seen.add(path)
+        self.sizes.pop(path, None)
+        self.failures.pop(path, None)
+        instruments.count('frames')
+        if not out:
+            print 'image extraction failed %s, skipping' % path
+            instruments.count('dropped')
+            return False
+        df, self.transform, flags = out
+        results = self.driver.results
+        results.append(df, self.transform, flags)
+        if config.keepDiagnostics:
+            self.driver.cruncher.diffPhotObjs.append(df)
+        if self.callback:
+            self.callback(results, len(results) - 1)
+        return True
+
+    def run(self, maxImages = None, timeout = None):
+        """poll and measure until stop is called (eg from another thread or the 
+        callback), maxImages have been measured, or timeout seconds pass
+        """
+        self.stopEvent.clear()
+        startTime = time.time()
+        nImages = 0
+        while not self.stopEvent.is_set():
+            for path in self.poll():
+                nImages += self.measure(path)
+                if maxImages is not None and nImages >= maxImages:
+                    return
+            if timeout is not None and time.time() - startTime > timeout:
+                return
+            self.stopEvent.wait(self.pollInterval)
+
+    def stop(self):
+        self.stopEvent.set()
+
+def sameTransform(transform, other):
+    """True if two FieldTransforms are exactly the same
+    """
+    return bool(numpy.array_equal(transform.rotation, other.rotation) and 
+        numpy.array_equal(transform.translation, other.translation))
+
+_crunchWorker = {} # what every chunk of a crunchLoop worker process shares, see _initCrunchWorker
+
+def _initCrunchWorker(cruncherClass, fieldSolution, ccd, imgList, config):
+    """Keep the state shared by all of Cruncher.crunchLoop's chunks in a worker 
+    process, run once as each worker starts
+    """
+    _crunchWorker.update(cruncherClass = cruncherClass, fieldSolution = fieldSolution, 
+        ccd = ccd, imgList = imgList, config = config)
+
+def _crunchChunk(args):
+    """Crunch one chunk of images in a worker process, for Cruncher.crunchLoop
+    args: (start, end, transform), crunch imgList[start:end] starting with transform,
+        see Cruncher.crunchChunk
+    returns the chunk's PhotTable, Fallbacks, DiffPhotObjs (if kept) and Instruments.  
+    Workers never plot.
+    """
+    start, end, transform = args
+    worker = _crunchWorker
+    cruncher = worker['cruncherClass'](worker['fieldSolution'], worker['ccd'], headless = True)
+    photTable = cruncher.crunchChunk(worker['imgList'][start:end], worker['config'], transform,
+        checkpointRows = False)
+    return photTable, cruncher.fallbacks, cruncher.diffPhotObjs, cruncher.instruments
+
+class Fallback(object):
+    """Record of an image where the target or comparisons weren't found at their
+    expected positions and the field had to be hashed, kept as data so nothing 
+    has to be drawn while crunching
+    """
+    def __init__(self, img, transform, targPos, compPos, targOK=False, compOK=None):
+        """inputs:
+        img: the img.Light which needed hashing
+        transform: the FieldTransform found by hashing, None if hashing failed
+        targPos: [x,y] expected target position (from transform if found)
+        compPos: list of [x,y] expected comparison positions
+        targOK: True if the target was centroided at targPos
+        compOK: list of True/False for each comparison
+        """
+        self.path = img.path
+        self.dateObs = img.dateObs
+        self.transform = transform
+        self.targPos = numpy.asarray(targPos)
+        self.compPos = numpy.asarray(compPos)
+        self.targOK = targOK
+        self.compOK = compOK if compOK is not None else [False]*len(compPos)
+
+    @property
+    def offset(self):
+        """offset of the field from the reference image, None if hashing failed
+        """
+        return None if self.transform is None else self.transform.offset
+
+    @property
+    def isOK(self):
+        return self.targOK and all(self.compOK)
+
+class CheckpointStore(object):
+    """Remembers the photometry (a phot.PhotTable row) of every image measured, so 
+    a rerun skips images that haven't changed.  Rows are keyed by a fingerprint of 
+    the image file (path, modification time and size), its calibration (see 
+    img.Calibrator.key), the photometry config and the field solution's star 
+    coordinates.  Stored as a file of JSON lines, 
+    appended to as each image is measured, so a crashed run keeps its work.
+    """
+    def __init__(self, path):
+        """path: the checkpoint file, read if it exists
+        """
+        self.path = path
+        self.rows = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue # partly written when a run died
+                    self.rows[entry['key']] = entry['row']
+
+    def fingerprint(self, image, config, fieldSolution):
+        """key for image, as calibrated by its calibrator, measured with config.phot 
+        and fieldSolution's stars
+        """
+        stat = os.stat(image.path)
+        fingerprint = [
+            os.path.abspath(image.path), stat.st_mtime, stat.st_size,
+            image.calibrator.key if image.calibrator else None,
+            sorted(vars(config.phot).items()),
+            numpy.asarray(fieldSolution.targetCoords).tolist(), 
+            numpy.asarray(fieldSolution.compCoords).tolist(),
+            ]
+        return hashlib.sha1(json.dumps(fingerprint)).hexdigest()
+
+    def get(self, key):
+        """the phot.PhotTable row stored under key, or None
+        """
+        return self.rows.get(key)
+
+    def put(self, key, row):
+        """store a phot.PhotTable row under key, written straight to the file
+        """
+        self.rows[key] = row
+        line = json.dumps({'key': key, 'row': row}) + '\n'
+        # a single append, so worker processes sharing the file don't interleave lines
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def transform(row):
+        """the FieldTransform of a stored row
+        """
+        return FieldTransform(row['rotation'], -numpy.asarray(row['offset']))
+
 class FieldSolution(object):
     """Contains information about where to find target and reference stars, and a hash
     table for the image in case of shifts
@@ -1,16 +1,143 @@
 """Image objects and ways to combine them
 
 todo?:
--add a reject algorithms to imcombine
 -how to deal with an unfull calibrator? ie without any flats, just bias?
 """
 import pyfits
 import numpy
+import collections
+import itertools
+import threading
+import multiprocessing.pool
+import os
+import hashlib
+import tempfile
+import json
+import instrument
+
+FITSBLOCK = 2880 # bytes, FITS files are made of blocks this size
+
+def readSections(path, regions):
+    """Read only some regions of an image file.  The file is memory mapped, so only 
+    the pixels asked for are read from disk.
+    
+    inputs:
+    path: path to the image file
+    regions: list of (row slice, column slice) regions to read
+    
+    returns:
+    list of float arrays, one per region, with BSCALE and BZERO applied
+    """
+    # scale the regions ourselves, pyfits won't scale memory mapped data
+    imgFile = pyfits.open(path, memmap=True, do_not_scale_image_data=True)
+    try:
+        hdu = imgFile[0]
+        bscale = hdu.header.get('BSCALE', 1)
+        bzero = hdu.header.get('BZERO', 0)
+        # section only reads the requested pixels
+        return [numpy.asarray(hdu.section[region], dtype=float) * bscale + bzero for region in regions]
+    finally:
+        imgFile.close()
+
+def imgShape(path):
+    """shape of the image data in path, from the header
+    """
+    header = pyfits.getheader(path)
+    return (header['NAXIS2'], header['NAXIS1'])
+
+def fitsSize(path):
+    """bytes the primary HDU of the FITS file path takes up when completely written 
+    (header plus data, padded to whole FITS blocks), from its header.  None if the
+    header isn't all written yet.  Read directly, so a file still being written 
+    can be checked.
+    """
+    cards = {}
+    nHeader = 0
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(FITSBLOCK)
+            if len(block) < FITSBLOCK:
+                return None
+            nHeader += FITSBLOCK
+            for start in range(0, FITSBLOCK, 80):
+                keyword = block[start:start+8].strip()
+                if keyword == 'END':
+                    nAxis = int(cards.get('NAXIS', 0))
+                    nData = abs(int(cards['BITPIX'])) // 8 if nAxis else 0
+                    for axis in range(1, nAxis + 1):
+                        nData *= int(cards['NAXIS%i' % axis])
+                    return nHeader + nData + (-nData % FITSBLOCK)
+                if block[start+8:start+10] == '= ':
+                    cards[keyword] = block[start+10:start+80].split('/')[0].strip()
+
+class FrameCache(object):
+    """A bounded least recently used cache of (calibrated) image data.  Share one
+    between images so each frame is only read and calibrated once while it's in use.
+    """
+    def __init__(self, maxBytes):
+        """
+        maxBytes: memory budget for cached data, least recently used frames are
+            dropped to stay under it
+        """
+        self.maxBytes = maxBytes
+        self.nBytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._frames = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the data stored under key, or None if it isn't cached
+        """
+        with self._lock:
+            data = self._frames.pop(key, None)
+            if data is None:
+                self.misses += 1
+                return None
+            # reinsert as the most recently used
+            self._frames[key] = data
+            self.hits += 1
+            return data
+
+    def put(self, key, data):
+        """Store data under key, evicting the least recently used frames as needed.
+        A read only view of data is kept, since everybody gets the same array back
+        (data itself is left writeable, so don't change it once it's stored).
+        """
+        if data.nbytes > self.maxBytes:
+            return
+        data = data.view()
+        data.flags.writeable = False
+        with self._lock:
+            old = self._frames.pop(key, None)
+            if old is not None:
+                self.nBytes -= old.nbytes
+            while self._frames and self.nBytes + data.nbytes > self.maxBytes:
+                evictKey, evicted = self._frames.popitem(last=False)
+                self.nBytes -= evicted.nbytes
+            self._frames[key] = data
+            self.nBytes += data.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._frames.clear()
+            self.nBytes = 0
+
+    def __len__(self):
+        return len(self._frames)
+
+    def __getstate__(self):
+        # locks can't be pickled, and data is not worth shipping between processes.
+        # Other processes start with an empty cache of the same size
+        return {'maxBytes': self.maxBytes}
+
+    def __setstate__(self, state):
+        self.__init__(state['maxBytes'])
 
 class Img(object):
     """Base class for images
     """
-    def __init__(self, path, dateObs, exptime, filter=None, type=None, calibrator=None):
+    def __init__(self, path, dateObs, exptime, filter=None, type=None, calibrator=None, cache=None):
         """    
         inputs: 
         path: path to the image file
@@ -18,37 +145,164 @@ class Img(object):
         exptime: the exposure time
         type: image type, defined by subclasses...
         filter: filter used
+        calibrator: a Calibrator applied to the data, or None
+        cache: a FrameCache to keep calibrated data in, or None to read the file 
+            every time
         """
         self.path = path
         self.dateObs = dateObs
         self.exptime = float(exptime)
-        if type not in ['bias', 'flat', 'light']:
-            raise RuntimeError('image must be of the type: bias, flat, or light, got %s' % type)
+        if type not in ['bias', 'dark', 'flat', 'light']:
+            raise RuntimeError('image must be of the type: bias, dark, flat, or light, got %s' % type)
         self.type = type
         self.filter = filter
         self.calibrator = calibrator
+        self.cache = cache
         
     @property        
     def data(self):
-        img = pyfits.open(self.path)
-        data = img[0].data
-        img.close()
+        """The (calibrated) image data, read only, from the cache if it's there
+        """
+        return self.getData()
+
+    def getData(self, instruments=instrument.NULL):
+        """The (calibrated) image data, from the cache if it's there.  Always read 
+        only, cached or not, copy it to change it.
+        instruments: an instrument.Instruments timing the 'read' and 'calibrate' stages
+        """
+        if self.cache is None:
+            data = self.readData(instruments)
+            data.flags.writeable = False
+            return data
+        # calibrated data depends on the calibration too
+        key = (self.path, self.calibrator.key if self.calibrator else None)
+        data = self.cache.get(key)
+        if data is None:
+            data = self.readData(instruments)
+            data.flags.writeable = False
+            self.cache.put(key, data)
+        else:
+            instruments.count('cacheHits')
+        return data
+
+    def readData(self, instruments=instrument.NULL):
+        """Read the image file and apply calibrations, skipping any cache
+        """
+        with instruments.stage('read'):
+            img = pyfits.open(self.path)
+            data = img[0].data
+            img.close()
         if self.calibrator:
             # apply calibrations
-            data = self.calibrator.calibrate(data)
+            with instruments.stage('calibrate'):
+                data = self.calibrator.calibrate(data, self.filter, exptime=self.exptime)
         return data
     
+    def readWindows(self, xyCtrs, halfSize, instruments=instrument.NULL):
+        """Read (and calibrate) only square windows of the image around some 
+        positions.  The file is memory mapped, so only the pixels in the 
+        windows are read from disk.
+        
+        inputs:
+        xyCtrs: list of xy positions to center windows on
+        halfSize: windows extend this many pixels on each side of their center
+            pixel.  They are clipped at the image edges.
+        
+        returns:
+        a FrameWindows object
+        """
+        calibrator = self.calibrator
+        with instruments.stage('read'):
+            shape = imgShape(self.path)
+            # positions are in calibrated (trimmed) pixels, the file in raw ones
+            lo = numpy.zeros(2, dtype=int)
+            hi = numpy.array([shape[1], shape[0]])
+            if calibrator and calibrator.trim is not None:
+                trimShape = calibrator.calibratedShape(shape)
+                lo = calibrator.toRaw([0, 0]).astype(int)
+                hi = lo + [trimShape[1], trimShape[0]]
+            regions = []
+            origins = []
+            for xyCtr in xyCtrs:
+                centerPix = lo + numpy.round(numpy.asarray(xyCtr, dtype=float)).astype(int)
+                x0, y0 = numpy.clip(centerPix - halfSize, lo, hi)
+                x1, y1 = numpy.clip(centerPix + halfSize + 1, lo, hi)
+                regions.append((slice(y0, y1), slice(x0, x1)))
+                origins.append(numpy.array([x0, y0]) - lo)
+            if calibrator and calibrator.overscan is not None:
+                windows = readSections(self.path, regions + [calibrator.overscan])
+                overscanLevel = numpy.median(windows.pop())
+            else:
+                windows = readSections(self.path, regions)
+                overscanLevel = None
+        if calibrator:
+            with instruments.stage('calibrate'):
+                windows = [calibrator.calibrate(data, self.filter, region=region, 
+                                exptime=self.exptime, overscanLevel=overscanLevel) 
+                                for data, region in zip(windows, regions)]
+            shape = calibrator.calibratedShape(shape)
+        return FrameWindows(windows, origins, shape)
+
     def setCalibrator(self, calibrator):
         """Add (or switch) a calibrator, not sure if this will be useful
         """
         self.calibrator = calibrator
         
+class FrameWindows(object):
+    """Square windows of data cut from one image, see Img.readWindows.  Can stand in
+    for the full image data when doing photometry with phot.ApPhot
+    """
+    def __init__(self, windows, origins, shape):
+        """inputs:
+        windows: list of 2d data arrays
+        origins: list of xy positions of the first pixel of each window in the full image
+        shape: shape of the full image
+        """
+        self.windows = windows
+        self.origins = origins
+        self.shape = shape
+
+    def __len__(self):
+        return len(self.windows)
+
+    def regionCube(self, centerPix, boxSize):
+        """Cut the square region boxSize pixels around each centerPix out of
+        whichever window holds it, and stack them into an N x k x k cube. 
+        
+        returns
+        cube: the stacked regions (nan where no window holds the region)
+        inside: N boolean array, False where no window holds the whole region
+        """
+        boxLen = 2*boxSize + 1
+        cube = numpy.zeros((len(centerPix), boxLen, boxLen)) + numpy.nan
+        inside = numpy.zeros(len(centerPix), dtype=bool)
+        for ind, xyPix in enumerate(centerPix):
+            # windows are usually cut around the same stars in the same order, so 
+            # look in the star's own window first (thousands of stars in full 
+            # field mode would otherwise search every window for every star)
+            ownWindow = [ind] if ind < len(self.windows) else []
+            for winInd in itertools.chain(ownWindow, xrange(len(self.windows))):
+                window = self.windows[winInd]
+                x0, y0 = xyPix - boxSize - self.origins[winInd]
+                if x0 >= 0 and y0 >= 0 and x0 + boxLen <= window.shape[1] and \
+                                            y0 + boxLen <= window.shape[0]:
+                    cube[ind] = window[y0:y0+boxLen, x0:x0+boxLen]
+                    inside[ind] = True
+                    break
+        return cube, inside
+
 class Bias(Img):
     """Raw bias image
     """
     def __init__(self, path, dateObs, exptime=0, type='bias'):
         Img.__init__(self, path, dateObs, exptime, type)
 
+class Dark(Img):
+    """Raw Dark image
+    """
+    def __init__(self, path, dateObs, exptime, type='dark'):
+        Img.__init__(self, path, dateObs, exptime, type=type)
+
 class Flat(Img):
     """Raw Flat-field image
     """
@@ -65,71 +319,379 @@ class Light(Img):
 class ImgCombine(object):
     """A generic method for combining images
     returns a combined image
+    
+    Images are streamed from disk a tile of rows at a time, so memory use stays
+    under maxBytes (besides the combined image) however many images are combined.
     """
-    def __init__(self, combType=None):
+    # peak number of tile stack sized float64 arrays alive while combining one, 
+    # the stack included (numpy's median copies it, nanmedian makes several)
+    stackCopies = {'mean': 1, 'median': 2, 'sigclip': 5}
+
+    def __init__(self, combType='median', maxBytes=256*1024**2, nThreads=1, nSigma=3., maxIter=5):
         """inputs:
-        combType: a numpy.<something> function
+        combType: 'mean', 'median' or 'sigclip' (iterative sigma clipped mean)
+        maxBytes: memory cap for the tiles of image stack being combined at once, 
+            and their temporaries
+        nThreads: number of threads combining tiles, they share maxBytes
+        nSigma: 'sigclip' rejects pixels further than this many standard deviations 
+            from the median
+        maxIter: maximum number of 'sigclip' rejection passes
         """
+        if combType not in ['mean', 'median', 'sigclip']:
+            raise RuntimeError('combType must be "mean", "median" or "sigclip", got %s' % combType)
         self.combType = combType
+        self.maxBytes = maxBytes
+        self.nThreads = nThreads
+        self.nSigma = nSigma
+        self.maxIter = maxIter
     
-    def __call__(imgList):
+    def __call__(self, imgList, subtract=None):
         """imgList: a list of Img, or subclass objects
+        subtract: a full frame array to subtract from each image before combining
+            (eg a master bias), or None
         """
         nImg = len(imgList)
-        x,y = imgList[0].shape
-        # make a 3d image stack, then operate on the 3rd axis
-        # initialize as zeros
-        imgStack = numpy.zeros((x, y, nImg))
-        for iter, img in enumerate(imgList):
-            imgStack[:,:,iter]=img.data
-        return self.combtype(imgStack, axis=2)
+        nRows, nCols = imgShape(imgList[0].path)
+        # each thread holds one float64 tile stack (and its temporaries) at a time
+        stackBytes = self.nThreads * self.stackCopies[self.combType] * nImg * nCols * 8
+        rowsPerTile = max(1, self.maxBytes // stackBytes)
+        tiles = [(start, min(start + rowsPerTile, nRows)) for start in range(0, nRows, rowsPerTile)]
+        combined = numpy.zeros((nRows, nCols))
+        def doTile(tile):
+            start, end = tile
+            combined[start:end] = self.combineStack(self.readStack(imgList, start, end, subtract))
+        if self.nThreads > 1:
+            pool = multiprocessing.pool.ThreadPool(self.nThreads)
+            try:
+                pool.map(doTile, tiles)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            map(doTile, tiles)
+        return combined
+
+    def readStack(self, imgList, start, end, subtract=None):
+        """Read rows start to end of every image into a 3d stack (image, row, column)
+        """
+        region = (slice(start, end), slice(None))
+        stack = None
+        for ind, img in enumerate(imgList):
+            rows = readSections(img.path, [region])[0]
+            if stack is None:
+                stack = numpy.zeros((len(imgList),) + rows.shape)
+            stack[ind] = rows
+        if subtract is not None:
+            stack -= subtract[region]
+        return stack
+
+    def combineStack(self, stack):
+        """Combine a 3d stack along the first axis using self.combType
+        """
+        if self.combType == 'mean':
+            return numpy.mean(stack, axis=0)
+        if self.combType == 'median':
+            return numpy.median(stack, axis=0)
+        # iterative sigma clipping, rejected pixels are set to nan
+        for iter in range(self.maxIter):
+            center = numpy.nanmedian(stack, axis=0)
+            std = numpy.nanstd(stack, axis=0)
+            with numpy.errstate(invalid='ignore'):
+                # rejected (nan) pixels compare False, they stay rejected
+                reject = numpy.abs(stack - center) > self.nSigma * std
+            if not numpy.any(reject):
+                break
+            stack[reject] = numpy.nan
+        return numpy.nanmean(stack, axis=0)
+
+    @property
+    def settings(self):
+        """the settings that change the combined image (not how it's computed)
+        """
+        return (self.combType, self.nSigma, self.maxIter)
+
+zeroCombine = ImgCombine('mean')
+flatCombine = ImgCombine('median')
+darkCombine = ImgCombine('median')
+
+class MasterCache(object):
+    """Keeps combined master calibration frames on disk as .npy files, so they are only
+    combined once.  Entries are named by a hash of everything that goes into them: 
+    the input files with their modification times and sizes, how they are combined and
+    the camera constants.  Changing any of these just makes a new entry.
+    """
+    def __init__(self, cacheDir):
+        """cacheDir: directory to keep master frames in, created if needed
+        """
+        self.cacheDir = cacheDir
+        if not os.path.isdir(cacheDir):
+            os.makedirs(cacheDir)
+
+    @staticmethod
+    def key(imgList, combiner, *extra):
+        """Return the key for the master frame made by combining imgList, whether 
+        or not it's cached
+        inputs:
+        imgList: list of Img objects to be combined
+        combiner: the ImgCombine doing the combining
+        extra: anything else the master frame depends on (reprs are hashed)
+        """
+        fileInfo = []
+        for img in imgList:
+            path = os.path.abspath(img.path)
+            stat = os.stat(path)
+            fileInfo.append((path, stat.st_mtime, stat.st_size))
+        keyStr = repr((sorted(fileInfo), combiner.settings, extra))
+        return hashlib.sha1(keyStr).hexdigest()
 
-zeroCombine = ImgCombine(numpy.average)
-flatCombine = ImgCombine(numpy.median)
+    def path(self, key):
+        return os.path.join(self.cacheDir, 'master_%s.npy' % key)
+
+    def get(self, key, makeMaster):
+        """Return the master frame for key, memory mapped from the cache.  If it isn't
+        there, make it by calling makeMaster() and store it first.
+        """
+        path = self.path(key)
+        if not os.path.exists(path):
+            master = makeMaster()
+            # write somewhere else then move it in place, so a crash never 
+            # leaves a partial entry behind
+            fd, tmpPath = tempfile.mkstemp(suffix='.npy', dir=self.cacheDir)
+            with os.fdopen(fd, 'wb') as f:
+                numpy.save(f, master)
+            os.rename(tmpPath, path)
+        return numpy.load(path, mmap_mode='r')
+
+class _MasterFile(object):
+    """Stands in for a master frame memory mapped from a MasterCache file while a 
+    Calibrator is pickled, so only the path is sent
+    """
+    def __init__(self, path):
+        self.path = path
+
+    @classmethod
+    def pack(cls, frame):
+        if isinstance(frame, numpy.memmap) and frame.filename:
+            return cls(frame.filename)
+        return frame
+
+    @classmethod
+    def unpack(cls, frame):
+        if isinstance(frame, cls):
+            return numpy.load(frame.path, mmap_mode='r')
+        return frame
+
+def cameraKey(cameraConst):
+    """the camera constants (a config.CameraConst) that calibration depends on, for 
+    MasterCache keys
+    """
+    if cameraConst is None:
+        return None
+    return sorted((name, value) for name, value in vars(cameraConst).items() 
+                        if isinstance(value, (str, int, float)))
 
 #calibrator should calibrate the img
 
 class Calibrator(object):
     """object that holds the calibration frames
+
+    Frames are calibrated in one buffer of dtype: the raw pixels are copied in 
+    once, then the bias (plus overscan level and exposure scaled dark) is 
+    subtracted and the reciprocal master flat multiplied in place, so no full 
+    frame temporaries are made.
     """
-    def __init__(self, biasList, flatList):
+    def __init__(self, biasList, flatList, biasCombine=zeroCombine, flatCombine=flatCombine,
+                    masterCache=None, cameraConst=None, darkList=None, darkCombine=darkCombine,
+                    dtype=numpy.float32, overscan=None, trim=None):
         """
         biasList: a list of img.Bias image objects. 
         flatList: a list of img.Flat Objects.
+        biasCombine: ImgCombine used to make the master bias
+        flatCombine: ImgCombine used to make the master flats
+        masterCache: a MasterCache to keep master frames in between runs, or None to 
+            always combine them
+        cameraConst: the camera constants, part of the masterCache key
+        darkList: a list of img.Dark objects, all of one exposure time, or None for
+            no dark subtraction.  The dark current is scaled to each image's 
+            exposure time.
+        darkCombine: ImgCombine used to make the master dark
+        dtype: numpy dtype of calibrated images
+        overscan: (row slice, column slice) of the raw frame holding overscan 
+            pixels, their median is subtracted from each frame, or None
+        trim: (row slice, column slice) of the raw frame to keep (the data section),
+            or None to keep the whole frame.  Calibrated full frames and image 
+            coordinates are of the trimmed frame.
         """
-        
-        self.bias = zeroCombine(biasList) if biasList else None # combine into master bias
-        self.flat = dealWithFlats(flatList) if flatList else None# dict of master flats indexed by filter
+        self.biasCombine = biasCombine
+        self.flatCombine = flatCombine
+        self.darkCombine = darkCombine
+        self.masterCache = masterCache
+        self.cameraKey = cameraKey(cameraConst)
+        self.dtype = numpy.dtype(dtype)
+        self.overscan = overscan
+        self.trim = trim
+        # MasterCache keys of the master frames, made even when they aren't cached
+        self.biasKey = MasterCache.key(biasList, biasCombine, 'bias', self.cameraKey) if biasList else None
+        self.flatKeys = {} # filter: key
+        self.darkKey = None
+        if biasList and masterCache:
+            self.bias = masterCache.get(self.biasKey, lambda: biasCombine(biasList))
+        else:
+            self.bias = biasCombine(biasList) if biasList else None # combine into master bias
+        self.flat = self.dealWithFlats(flatList) if flatList else None# dict of master flats indexed by filter
+        self.invFlat = self.reciprocalFlats()
+        self.dark = self.makeMasterDark(darkList) if darkList else None # dark current, counts/s
+        self._offsets = {} # exptime: bias + scaled dark, in the calibration dtype
+        self._offsetLock = threading.Lock()
+        # identifies the calibration done, the same from run to run while the
+        # masters' input files and these settings don't change
+        self.key = hashlib.sha1(repr((self.biasKey, sorted(self.flatKeys.items()), self.darkKey, 
+            self.dtype.str, self.overscan, self.trim, self.cameraKey))).hexdigest()
             
-    def applyBias(self, imgData):
+    def reciprocalFlats(self):
+        """the master flats, to be multiplied rather than divided, in the calibration 
+        dtype, normalized over the part of the frame that's kept.  A dict indexed by 
+        filter
+        """
+        invFlat = {}
+        for filter, flat in (self.flat or {}).iteritems():
+            with numpy.errstate(divide='ignore'):
+                invFlat[filter] = (numpy.median(self._regionOf(flat, self.trim)) / flat).astype(self.dtype)
+        return invFlat
+
+    def __getstate__(self):
+        # locks can't be pickled, other processes rebuild the offsets and reciprocal 
+        # flats they need.  Master frames from a MasterCache are sent as their paths
+        state = self.__dict__.copy()
+        del state['_offsets'], state['_offsetLock'], state['invFlat']
+        state['bias'] = _MasterFile.pack(self.bias)
+        state['dark'] = _MasterFile.pack(self.dark)
+        if self.flat is not None:
+            state['flat'] = dict((filter, _MasterFile.pack(flat)) for filter, flat in self.flat.iteritems())
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.bias = _MasterFile.unpack(self.bias)
+        self.dark = _MasterFile.unpack(self.dark)
+        if self.flat is not None:
+            self.flat = dict((filter, _MasterFile.unpack(flat)) for filter, flat in self.flat.iteritems())
+        self.invFlat = self.reciprocalFlats()
+        self._offsets = {}
+        self._offsetLock = threading.Lock()
+
+    def applyBias(self, imgData, region=None):
         """inputs:
         img: an img.Light object
         filter: an image filter, if None, no flat fielding is applied
+        region: (row slice, column slice) of the full frame imgData was cut from, 
+            or None if imgData is the full frame
         returns:
         calibrated image array
         """
         # subtract the bias
-        return imgData - self.bias
+        return imgData - self._regionOf(self.bias, region)
         
-    def applyFlat(self, imgData, filter):
+    def applyFlat(self, imgData, filter, region=None):
         """inputs:
         img: an img.Light object
-        filter: an image filter, if None, no flat fielding is applied
+        filter: an image filter, if None (or there's no flat for it), no flat 
+            fielding is applied
+        region: (row slice, column slice) of the full frame imgData was cut from, 
+            or None if imgData is the full frame
         returns:
         calibrated image array
         """
-        return imgData / self.flat[filter]
+        if filter is None or filter not in self.invFlat:
+            return imgData
+        return imgData * self._regionOf(self.invFlat[filter], region)
     
-    def calibrate(self, imgData):
-        """Apply bias and flat field to imgData
-        """
-        if self.bias:
-            imgData = self.applyBias(imgData)
-            if self.flat:
-                imgData = self.applyFlat(imgData)
-        return imgData
-         
-        
+    def calibrate(self, imgData, filter=None, region=None, exptime=None, overscanLevel=None):
+        """Apply bias (and overscan and dark) and flat field to imgData, returning a 
+        new array of self.dtype (imgData is not changed)
+        filter: the image's filter, picks the master flat.  If None no flat fielding 
+            is applied
+        region: (row slice, column slice) of the raw frame imgData was cut from,
+            or None if imgData is the full raw frame (which is then trimmed)
+        exptime: the image's exposure time, scales the dark.  If None no dark is 
+            subtracted
+        overscanLevel: the frame's overscan level, if imgData is only a region of 
+            it (see Img.readWindows).  Measured from imgData if it's the full frame.
+        """
+        if region is None:
+            if self.overscan is not None:
+                overscanLevel = numpy.median(imgData[self.overscan])
+            if self.trim is not None:
+                imgData = imgData[self.trim]
+                region = self.trim
+        # the one buffer everything is done in
+        out = numpy.array(imgData, dtype=self.dtype)
+        if self.bias is not None or self.dark is not None:
+            out -= self._regionOf(self.offset(exptime), region)
+        if overscanLevel is not None:
+            out -= self.dtype.type(overscanLevel)
+        if filter in self.invFlat:
+            out *= self._regionOf(self.invFlat[filter], region)
+        return out
+
+    def offset(self, exptime=None):
+        """bias plus the dark for exptime (cached for every exposure time seen) in 
+        self.dtype, the overscan level of the master bias removed if there is 
+        an overscan
+        """
+        key = exptime if self.dark is not None else None
+        with self._offsetLock:
+            offset = self._offsets.get(key)
+            if offset is None:
+                if self.bias is not None:
+                    offset = numpy.array(self.bias, dtype=self.dtype)
+                    if self.overscan is not None:
+                        # each frame's own overscan level is subtracted instead
+                        offset -= numpy.median(self.bias[self.overscan])
+                else:
+                    offset = numpy.zeros(self.dark.shape, dtype=self.dtype)
+                if key is not None:
+                    offset += (self.dark * exptime).astype(self.dtype)
+                self._offsets[key] = offset
+        return offset
+
+    def _regionOf(self, calFrame, region):
+        """the part of a full frame calibration image matching region
+        """
+        if region is None:
+            return calFrame
+        return calFrame[region]
+
+    def toRaw(self, xy):
+        """xy position(s) in calibrated (trimmed) image coordinates, in raw frame 
+        coordinates
+        """
+        if self.trim is None:
+            return numpy.asarray(xy, dtype=float)
+        return numpy.asarray(xy, dtype=float) + [self.trim[1].start or 0, self.trim[0].start or 0]
+
+    def calibratedShape(self, rawShape):
+        """shape of a calibrated full frame, given the raw frame's
+        """
+        if self.trim is None:
+            return tuple(rawShape)
+        return tuple(len(xrange(*section.indices(length))) for section, length in zip(self.trim, rawShape))
+
+    def makeMasterDark(self, darkList):
+        """combine darkList (all one exposure time) into the dark current, counts/s
+        """
+        exptimes = set(dark.exptime for dark in darkList)
+        if len(exptimes) != 1:
+            raise RuntimeError('darks must all have the same exposure time, got %s' % sorted(exptimes))
+        exptime = float(exptimes.pop())
+        if exptime <= 0:
+            raise RuntimeError('darks must have a positive exposure time, got %s' % exptime)
+        # the bias is removed from each dark as it's read
+        makeDark = lambda: self.darkCombine(darkList, subtract=self.bias) / exptime
+        self.darkKey = MasterCache.key(darkList, self.darkCombine, 'dark', self.biasKey, self.cameraKey)
+        if self.masterCache:
+            return self.masterCache.get(self.darkKey, makeDark)
+        return makeDark()
             
     def dealWithFlats(self, flatList):
         """sort and combine flatList into a flat dictionary, indexed by the filter
@@ -141,50 +703,189 @@ class Calibrator(object):
             if filter not in flatDict.keys():
                 # add the flat key to the dictionary, initialize with empty list
                 flatDict[filter] = []
-            # add the image to the key, with bias removed
-            flatDict[filter].append(flat -  self.bias)
+            flatDict[filter].append(flat)
         # next combine lists of flat images into a master flat for each filter
         for flat, imgList in flatDict.iteritems():
-            masterFlat = flatCombine(imgList)
             # overwrite image list in dictionary with master flat
-            # and subtract the bias from it
-            flatDict[flat] = masterFlat 
+            # flats depend on the bias removed from them too
+            self.flatKeys[flat] = MasterCache.key(imgList, self.flatCombine, 'flat', flat, 
+                                            self.biasKey, self.cameraKey)
+            if self.masterCache:
+                flatDict[flat] = self.masterCache.get(self.flatKeys[flat], 
+                                            lambda: self.makeMasterFlat(imgList))
+            else:
+                flatDict[flat] = self.makeMasterFlat(imgList)
         return flatDict
+
+    def makeMasterFlat(self, imgList):
+        """combine a list of flats (all the same filter) into a master flat
+        """
+        # the bias is removed from each flat as it's read
+        masterFlat = self.flatCombine(imgList, subtract=self.bias)
+        # normalized to 1 so calibrated images keep their count levels
+        return masterFlat / numpy.median(masterFlat)
             
-def imgLister(fileList, type, cameraConst, calibrator=None):
+class Prefetcher(object):
+    """Iterate over a list of images getting (img, img.data) pairs, while background
+    threads read and calibrate the next few images, so reading overlaps with
+    whatever is done with the data.
+    """
+    def __init__(self, imgList, depth, nThreads=None, instruments=instrument.NULL):
+        """inputs:
+        imgList: list of Img objects
+        depth: how many images to read ahead of the one being used
+        nThreads: number of reading threads, default depth
+        instruments: an instrument.Instruments to time reading, calibrating and 
+            waiting for images in
+        """
+        self.imgList = imgList
+        self.depth = depth
+        self.nThreads = nThreads or depth
+        self.instruments = instruments
+
+    def __iter__(self):
+        pool = multiprocessing.pool.ThreadPool(self.nThreads)
+        imgIter = iter(self.imgList)
+        pending = collections.deque()
+        def readAhead():
+            for img in imgIter:
+                pending.append((img, pool.apply_async(img.getData, (self.instruments,))))
+                return
+        try:
+            for i in range(self.depth + 1):
+                readAhead()
+            while pending:
+                img, result = pending.popleft()
+                readAhead()
+                with self.instruments.stage('prefetchWait'):
+                    data = result.get()
+                yield img, data
+        finally:
+            # don't wait on reads nobody will use
+            pool.terminate()
+            pool.join()
+
+class HeaderManifest(object):
+    """A sidecar file remembering header values of image files, so files that haven't
+    changed (same modification time and size) don't need to be opened again.
+    Stored as JSON, keyed by absolute path.
+    """
+    def __init__(self, path):
+        """path: the manifest file, read if it exists
+        """
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.entries = json.load(f)
+
+    def lookup(self, filePath, keywords):
+        """Return the remembered {keyword: value} for filePath, or None if the file 
+        changed, is new, or some keywords weren't remembered
+        """
+        entry = self.entries.get(os.path.abspath(filePath))
+        if entry is None or entry['stat'] != self._stat(filePath):
+            return None
+        if not set(keywords).issubset(entry['header']):
+            return None
+        return entry['header']
+
+    def store(self, filePath, header):
+        """remember {keyword: value} header values for filePath
+        """
+        self.entries[os.path.abspath(filePath)] = {'stat': self._stat(filePath), 'header': header}
+
+    def save(self):
+        """write the manifest, via a temporary file so it's never left half written
+        """
+        fd, tmpPath = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)))
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.entries, f)
+        os.rename(tmpPath, self.path)
+
+    def _stat(self, filePath):
+        stat = os.stat(filePath)
+        return [stat.st_mtime, stat.st_size]
+
+def readHeaders(fileList, keywords, manifest=None, nThreads=8):
+    """Read some header values from many image files, using a pool of threads
+    inputs:
+    fileList: list of image files
+    keywords: list of header keywords to read
+    manifest: a HeaderManifest, files it remembers aren't read, and files read 
+        are added to it (and it's saved).  None to read every file
+    nThreads: number of threads reading headers
+    
+    returns:
+    list of {keyword: value} dicts, one per file
+    """
+    headers = [manifest.lookup(file, keywords) if manifest else None for file in fileList]
+    toRead = [ind for ind, header in enumerate(headers) if header is None]
+    def readHeader(file):
+        # header only, the data isn't touched
+        header = pyfits.getheader(file)
+        return dict((keyword, header[keyword]) for keyword in keywords)
+    if toRead:
+        # pyfits imports some of its modules on first use, which isn't thread 
+        # safe, so read the first header before starting the pool
+        newHeaders = [readHeader(fileList[toRead[0]])]
+        pool = multiprocessing.pool.ThreadPool(max(1, min(nThreads, len(toRead) - 1)))
+        try:
+            newHeaders += pool.map(readHeader, [fileList[ind] for ind in toRead[1:]])
+        finally:
+            pool.close()
+            pool.join()
+        for ind, header in zip(toRead, newHeaders):
+            headers[ind] = header
+            if manifest:
+                manifest.store(fileList[ind], header)
+        if manifest:
+            manifest.save()
+    return headers
+
+def imgLister(fileList, type, cameraConst, calibrator=None, cache=None, manifest=None, nThreads=8):
     """function for building image lists from fileLists
     inputs:
     filelist: a list of strings defining each file
-    type: 'bias', 'flat', or 'light'
+    type: 'bias', 'dark', 'flat', or 'light'
     cameraConst: eg camera.flareCam.  Holds header solutions, etc
     calibrator: an image calibrator to go along with
+    cache: a FrameCache shared by all the images, or None
+    manifest: a HeaderManifest to remember header values between runs, or None
+    nThreads: number of threads reading headers
     
     output:
     imgList, a list of image objects, ordered by observed date
     """
+    keywords = [cameraConst.dateObs, cameraConst.exptime]
+    if type not in ['bias', 'dark']:
+        keywords.append(cameraConst.filter.strip()) # get filter used, strip whitespace
+    headers = readHeaders(fileList, keywords, manifest, nThreads)
     imgList = []
-    for file in fileList:
+    for file, header in zip(fileList, headers):
         # extract and save useful header data from each image
-        imgFile = pyfits.open(file)
-        if type == 'bias':
+        if type in ['bias', 'dark']:
             filter = None
         else:
-            filter = imgFile[0].header[cameraConst.filter.strip()] # get filter used, strip whitespace
-        dateObs = cameraConst.parseDate(imgFile[0].header[cameraConst.dateObs])
-        exptime = imgFile[0].header[cameraConst.exptime]
+            filter = header[cameraConst.filter.strip()]
+        dateObs = cameraConst.parseDate(header[cameraConst.dateObs])
+        exptime = header[cameraConst.exptime]
         imgList.append(
             Img(
                 path = file, dateObs = dateObs, exptime = exptime, 
                 filter = filter, type = type, 
-                calibrator = calibrator,
+                calibrator = calibrator, cache = cache,
             )
         )
-        imgFile.close()           
+    imgList.sort(key = lambda img: img.dateObs)
     return imgList
-           
-        
-        
-        
-        
-        
-    
+
+def groupByFilter(imgList):
+    """split imgList by filter
+    returns an OrderedDict of {filter: list of images}, filters in the order they
+    first appear, images in their order in imgList
+    """
+    groups = collections.OrderedDict()
+    for image in imgList:
+        groups.setdefault(image.filter, []).append(image)
+    return groups
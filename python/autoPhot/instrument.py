@@ -0,0 +1,187 @@
+"""Timers and counters for the stages of a reduction, cheap enough to leave on.
+
+    instruments = Instruments()
+    with instruments.frame(path):
+        with instruments.stage('read'):
+            ...
+    instruments.count('hashed')
+    instruments.report() # or instruments.save(path), as JSON
+"""
+import time
+import json
+import thread
+import threading
+import resource
+import sys
+import numpy
+
+# ru_maxrss is bytes on mac, KB on linux
+MAXRSSUNIT = 1 if sys.platform == 'darwin' else 1024
+
+def maxrss():
+    """peak resident memory of this process so far, bytes
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * MAXRSSUNIT
+
+class Instruments(object):
+    """Collects the duration (and peak memory) of every run of each named stage,
+    counters, and a record per frame of the time spent in each stage.  Stages may
+    be timed from several threads, frame records only include stages timed in the
+    thread that opened the frame.
+    """
+    def __init__(self):
+        self.durations = {} # stage name: list of seconds
+        self.maxrss = {} # stage name: peak memory (bytes) when it finished
+        self.rssGrowth = {} # stage name: largest increase of the peak during one run
+        self.counters = {}
+        self.frames = [] # {'path': , 'stages': {name: seconds}, 'seconds': }
+        self._frame = None
+        self._frameThread = None
+        self._lock = threading.Lock() # stages and counters are recorded from several threads
+
+    def stage(self, name):
+        """context manager timing one run of stage name
+        """
+        return _Stage(self, name)
+
+    def frame(self, path):
+        """context manager recording the stages of one frame
+        """
+        return _Frame(self, path)
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def record(self, name, seconds, rssBefore, rssAfter):
+        """add one run of a stage
+        """
+        with self._lock:
+            self.durations.setdefault(name, []).append(seconds)
+            self.maxrss[name] = max(self.maxrss.get(name, 0), rssAfter)
+            self.rssGrowth[name] = max(self.rssGrowth.get(name, 0), rssAfter - rssBefore)
+        if self._frame is not None and thread.get_ident() == self._frameThread:
+            frameStages = self._frame['stages']
+            frameStages[name] = frameStages.get(name, 0) + seconds
+
+    def merge(self, other):
+        """add another Instruments' records (eg from a worker process) to these
+        """
+        with self._lock:
+            for name, durations in other.durations.iteritems():
+                self.durations.setdefault(name, []).extend(durations)
+                self.maxrss[name] = max(self.maxrss.get(name, 0), other.maxrss[name])
+                self.rssGrowth[name] = max(self.rssGrowth.get(name, 0), other.rssGrowth[name])
+        for name, n in other.counters.iteritems():
+            self.count(name, n)
+        self.frames.extend(other.frames)
+
+    def __getstate__(self):
+        # locks can't be pickled (Instruments come back from worker processes),
+        # nor is a frame open in another process of any use
+        state = self.__dict__.copy()
+        del state['_lock']
+        state['_frame'] = state['_frameThread'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def report(self):
+        """summary of everything recorded, as a json friendly dict.  Stages have
+        the number of runs, total, mean, median, 90th, 99th percentile and max
+        seconds, and peak memory (MB) when they finished and its largest increase
+        during one run.
+        """
+        stages = {}
+        for name, durations in self.durations.iteritems():
+            durations = numpy.asarray(durations)
+            p50, p90, p99 = numpy.percentile(durations, [50, 90, 99])
+            stages[name] = {
+                'n': len(durations),
+                'total': float(durations.sum()),
+                'mean': float(durations.mean()),
+                'p50': float(p50),
+                'p90': float(p90),
+                'p99': float(p99),
+                'max': float(durations.max()),
+                'maxrssMB': self.maxrss[name] / 2.**20,
+                'rssGrowthMB': self.rssGrowth[name] / 2.**20,
+                }
+        return {'stages': stages, 'counters': dict(self.counters), 'frames': self.frames,
+            'maxrssMB': maxrss() / 2.**20}
+
+    def save(self, path):
+        """write the report as JSON
+        """
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=1)
+
+    def __str__(self):
+        lines = ['%-14s %6s %9s %9s %9s %9s %9s' % ('stage', 'n', 'total s', 'p50 ms', 'p90 ms', 'p99 ms', 'peak MB')]
+        for name, stage in sorted(self.report()['stages'].items(), key=lambda item: -item[1]['total']):
+            lines.append('%-14s %6i %9.3f %9.2f %9.2f %9.2f %9.1f' % (name, stage['n'], stage['total'],
+                stage['p50']*1e3, stage['p90']*1e3, stage['p99']*1e3, stage['maxrssMB']))
+        for name, n in sorted(self.counters.items()):
+            lines.append('%-14s %6i' % (name, n))
+        return '\n'.join(lines)
+
+class _Stage(object):
+    __slots__ = ['instruments', 'name', 'start', 'rss']
+
+    def __init__(self, instruments, name):
+        self.instruments = instruments
+        self.name = name
+
+    def __enter__(self):
+        self.rss = maxrss()
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.time() - self.start
+        self.instruments.record(self.name, seconds, self.rss, maxrss())
+        return False
+
+class _Frame(object):
+    def __init__(self, instruments, path):
+        self.instruments = instruments
+        self.record = {'path': path, 'stages': {}}
+
+    def __enter__(self):
+        self.instruments._frame = self.record
+        self.instruments._frameThread = thread.get_ident()
+        self.start = time.time()
+        return self.record
+
+    def __exit__(self, *exc):
+        self.record['seconds'] = time.time() - self.start
+        self.instruments.frames.append(self.record)
+        self.instruments._frame = None
+        return False
+
+class _NullStage(object):
+    """does nothing, for code run without Instruments
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+class NullInstruments(object):
+    """Stands in for Instruments when nothing is being recorded
+    """
+    _stage = _NullStage()
+
+    def stage(self, name):
+        return self._stage
+
+    def frame(self, path):
+        return self._stage
+
+    def count(self, name, n=1):
+        pass
+
+NULL = NullInstruments()
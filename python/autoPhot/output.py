@@ -1,9 +1,11 @@
 """Output Results in various ways
 """
 import viz
-import matplotlib.pyplot as plt
+import img
 import itertools
 import numpy
+import numpy.lib.format
+import os
 
 ZEROPOINT = 20
 
@@ -22,10 +24,63 @@ class Dump(object):
         if units not in ['Flux', 'Mag']:
             raise RuntimeError('units must be "Flux" or "Mag", received: %s' % units)
         self.units = units
+
+    def openWriters(self, formats = ('fits', 'npy'), name = 'photOut'):
+        """open streaming writers for the driver's photometry, named <name>.<format>
+        in outDir.  Flux is always written, regardless of units.
+        formats: list of keys of WRITERS
+        """
+        nStars = 1 + len(self.driver.fieldSolution.compCoords)
+        writers = []
+        for fmt in formats:
+            if fmt not in WRITERS:
+                raise RuntimeError('format must be one of %s, received: %s' % (WRITERS.keys(), fmt))
+            writers.append(WRITERS[fmt](os.path.join(self.outDir, name + '.' + fmt), nStars,
+                self.driver.config.phot.inrad))
+        return writers
+
+    def crunch(self, formats = ('fits', 'npy'), nProc = 1):
+        """crunch the driver's images, writing each image's row to the 
+        photOut files as soon as it's measured, so a partial run still leaves 
+        usable output
+        formats: see openWriters
+        nProc: see Driver.crunch
+        """
+        writers = self.openWriters(formats)
+        try:
+            self.driver.crunch(nProc = nProc, writers = writers)
+        finally:
+            for writer in writers:
+                writer.close()
+            self.saveReport()
+
+    def crunchFilters(self, formats = ('fits', 'npy'), nProc = 1):
+        """crunch each filter's images at once (see Driver.crunchFilters), streaming 
+        every filter's rows to its own files, photOut.<filter>.<format>
+        formats: see openWriters
+        nProc: see Driver.crunchFilters
+        """
+        writers = {}
+        try:
+            for filter in self.driver.config.objByFilter:
+                writers[filter] = self.openWriters(formats, 'photOut.%s' % fileSafe(filter))
+            self.driver.crunchFilters(nProc = nProc, writers = writers)
+        finally:
+            for filterWriters in writers.values():
+                for writer in filterWriters:
+                    writer.close()
+            self.saveReport()
+
+    def saveReport(self):
+        """save the driver's stage timings and counters (see instrument.Instruments)
+        as photOut.instruments.json
+        """
+        self.driver.instruments.save(os.path.join(self.outDir, 'photOut.instruments.json'))
         
     def saveField(self):
         """generate and save a figure from the extraction field
         """
+        import matplotlib.pyplot as plt
         fig = plt.figure()
         ax = fig.add_subplot(111)
         # note, field solution is the last extracted image
@@ -36,20 +91,25 @@ class Dump(object):
     def saveDatFile(self):
         targCounts, compCounts, diffCounts = self.getPhotData()
         nComps = compCounts.shape[1]
+        radii = numpy.atleast_1d(self.driver.config.phot.inrad)
         fileLines = [
-            'Aperture (radius, pixels) = %i' % self.driver.config.phot.inrad,
+            'Aperture (radius, pixels) = %s' % ', '.join('%g' % radius for radius in radii),
             'Sky Annulus (inner and outer radius, pixels) = %i, %i' % (self.driver.config.phot.skyann[0],self.driver.config.phot.skyann[1]),
             '------------------------------',
             ] 
-        lowerHead = ['Normalized Differential Photometry (Units = %s), Target (Units = %s), ' % (self.units, self.units)]
-        for num in range(nComps):
-            lowerHead.append('Comparison%i (Units = %s), ' % (num, self.units))
+        names = ['Normalized Differential Photometry', 'Target']
+        names += ['Comparison%i' % num for num in range(nComps)]
+        # with several apertures each quantity gets a column per radius
+        radiusLabels = [''] if numpy.ndim(self.driver.config.phot.inrad) == 0 else \
+            [' r=%g' % radius for radius in radii]
+        lowerHead = ['%s%s (Units = %s), ' % (name, label, self.units) 
+            for name in names for label in radiusLabels]
         lowerHead = ''.join(lowerHead)
         fileLines.append(lowerHead)
         for diff,targ,comp in itertools.izip(diffCounts, targCounts, compCounts):
-            slam = [diff]
-            slam.append(targ)
-            slam.extend(comp)
+            slam = list(numpy.ravel(diff))
+            slam.extend(numpy.ravel(targ))
+            slam.extend(numpy.ravel(comp))
             dataLine = []
             for phot in slam:
                 dataLine.append('%f' % phot)
@@ -62,28 +122,36 @@ class Dump(object):
             for line in fileLines:
                 f.write(line+'\n')
     
+    def saveFluxMatrix(self):
+        """save the driver's results as a stars x images matrix of flux (counts 
+        normalized by exposure time, nan where a star was off the image), 
+        photOut.flux.npy, for full field photometry (see flow.Driver.chooseField).
+        With several apertures it is stars x images x radii.  The stars' reference 
+        image positions are saved as photOut.stars.npy and the images' dates of 
+        observation as photOut.dateObs.npy.
+        """
+        results = self.driver.results
+        flux = (results.counts.T / results.exptime).T
+        numpy.save(os.path.join(self.outDir, 'photOut.flux.npy'), numpy.swapaxes(flux, 0, 1))
+        stars = numpy.vstack([self.driver.fieldSolution.targetCoords, self.driver.fieldSolution.compCoords])
+        numpy.save(os.path.join(self.outDir, 'photOut.stars.npy'), stars)
+        numpy.save(os.path.join(self.outDir, 'photOut.dateObs.npy'), results.dateObs)
+
     def saveLightCurves(self):
         """print out all light curves
         """
+        import matplotlib.pyplot as plt
         targCounts, compCounts, diffCounts = self.getPhotData()
         fig = plt.figure()
         
     
     def getPhotData(self):
-        """Loop through each extraction get all the fwhms
+        """get target, comparison and differential counts from the driver's results table
         """
-        targCounts = [] #1D
-        compCounts = [] #2D
-        diffCounts = [] #1D       
-        
-        for photObj in self.driver.df:
-            targCounts.append(photObj.targCounts)
-            compCounts.append(photObj.compCounts)  
-            diffCounts.append(photObj.diffCounts)
-            
-        targCounts = numpy.asarray(targCounts) #1D
-        compCounts = numpy.asarray(compCounts) #2D
-        diffCounts = numpy.asarray(diffCounts) #1D
+        results = self.driver.results
+        targCounts = results.targCounts #1D (2D with several apertures)
+        compCounts = results.compCounts #2D (3D)
+        diffCounts = results.diffCounts #1D (2D)
         
         if self.units == 'Mag':
             # convert counts to and (arbitrary magnitude)
@@ -97,4 +165,193 @@ class Dump(object):
         """convert flux to magnitude zeropoint is arbitrary
         """
         return -2.5*numpy.log10(array) + zeropoint        
-            
\ No newline at end of file
+            
+
+class RowWriter(object):
+    """Base class for writers appending phot.PhotTable rows to a file as they're 
+    measured.  Each row holds date of observation, exposure time, flux (counts
+    normalized by exposure time) and sky for every star (target first), the 
+    field offset and the phot.PhotTable flags.  Files are valid after every write.
+    With several aperture radii flux is nStars x nRadii.
+    """
+    def __init__(self, path, nStars, radii = None):
+        """inputs:
+        path: file to write, overwritten
+        nStars: number of stars, target plus comparisons
+        radii: the aperture radius, or a list of them (PhotConfig.inrad)
+        """
+        self.path = path
+        self.nStars = nStars
+        self.radii = None if radii is None or numpy.ndim(radii) == 0 else list(radii)
+        self.fluxShape = (nStars,) if self.radii is None else (nStars, len(self.radii))
+        self.nRows = 0
+        self.file = open(path, 'wb')
+        self.writeHeader()
+
+    def rowType(self, byteorder = '<'):
+        """numpy dtype of a row
+        """
+        floatType = byteorder + 'f8'
+        return numpy.dtype([
+            ('DATE-OBS', 'S26'),
+            ('EXPTIME', floatType),
+            ('FLUX', floatType, self.fluxShape),
+            ('SKY', floatType, (self.nStars,)),
+            ('OFFSET', floatType, (2,)),
+            ('FLAGS', byteorder + 'i4'),
+            ])
+
+    def rows(self, photTable, start, stop, byteorder = '<'):
+        """rows start:stop of photTable as a structured array
+        """
+        rows = numpy.zeros(stop - start, dtype = self.rowType(byteorder))
+        rows['DATE-OBS'] = numpy.datetime_as_string(photTable.dateObs[start:stop], unit = 'us')
+        rows['EXPTIME'] = photTable.exptime[start:stop]
+        rows['FLUX'] = (photTable.counts[start:stop].T / photTable.exptime[start:stop]).T
+        rows['SKY'] = photTable.sky[start:stop]
+        rows['OFFSET'] = photTable.offset[start:stop]
+        rows['FLAGS'] = photTable.flags[start:stop]
+        return rows
+
+    def write(self, photTable, start, stop):
+        """append rows start:stop of photTable
+        """
+        if stop <= start:
+            return
+        self.writeRows(photTable, start, stop)
+        self.nRows += stop - start
+        self.file.flush()
+
+    def writeHeader(self):
+        """defined by subclasses, write the start of the file
+        """
+        raise NotImplementedError('subclasses must override')
+
+    def writeRows(self, photTable, start, stop):
+        """defined by subclasses, append rows and keep the file valid
+        """
+        raise NotImplementedError('subclasses must override')
+
+    def close(self):
+        self.file.close()
+
+class FitsWriter(RowWriter):
+    """Write rows to a FITS binary table extension.  NAXIS2 is rewritten in place 
+    after every write.
+    """
+    def writeHeader(self):
+        self.rowBytes = self.rowType().itemsize
+        primary = [
+            fitsCard('SIMPLE', True),
+            fitsCard('BITPIX', 8),
+            fitsCard('NAXIS', 0),
+            fitsCard('EXTEND', True),
+            ]
+        columns = [('DATE-OBS', '26A'), ('EXPTIME', 'D'), ('FLUX', '%iD' % numpy.prod(self.fluxShape)), 
+            ('SKY', '%iD' % self.nStars), ('OFFSET', '2D'), ('FLAGS', 'J')]
+        table = [
+            fitsCard('XTENSION', 'BINTABLE'),
+            fitsCard('BITPIX', 8),
+            fitsCard('NAXIS', 2),
+            fitsCard('NAXIS1', self.rowBytes),
+            fitsCard('NAXIS2', 0),
+            fitsCard('PCOUNT', 0),
+            fitsCard('GCOUNT', 1),
+            fitsCard('TFIELDS', len(columns)),
+            ]
+        for num, (name, form) in enumerate(columns):
+            table.append(fitsCard('TTYPE%i' % (num + 1), name))
+            table.append(fitsCard('TFORM%i' % (num + 1), form))
+            if name == 'FLUX' and self.radii is not None:
+                # fortran order, radius varies fastest
+                table.append(fitsCard('TDIM%i' % (num + 1), '(%i,%i)' % (len(self.radii), self.nStars)))
+        for num, radius in enumerate(self.radii or []):
+            table.append(fitsCard('APRAD%i' % (num + 1), float(radius)))
+        primary = fitsHeader(primary)
+        self.naxis2Pos = len(primary) + 4 * 80
+        table = fitsHeader(table)
+        self.dataStart = len(primary) + len(table)
+        self.file.write(primary + table)
+
+    def writeRows(self, photTable, start, stop):
+        dataEnd = self.dataStart + (self.nRows + stop - start) * self.rowBytes
+        self.file.seek(self.dataStart + self.nRows * self.rowBytes)
+        self.file.write(self.rows(photTable, start, stop, byteorder = '>').tostring())
+        self.file.write('\0' * (-dataEnd % img.FITSBLOCK))
+        self.file.truncate()
+        self.file.seek(self.naxis2Pos)
+        self.file.write(fitsCard('NAXIS2', self.nRows + stop - start))
+
+class NpyWriter(RowWriter):
+    """Write rows to a .npy file of a structured array (load with numpy.load).  The
+    header is padded so the shape can be rewritten in place after every write.
+    """
+    HEADERSIZE = 256 # bytes, including the magic string
+
+    def writeHeader(self):
+        self.descr = numpy.lib.format.dtype_to_descr(self.rowType())
+        self.writeShape(0)
+
+    def writeShape(self, nRows):
+        header = "{'descr': %r, 'fortran_order': False, 'shape': (%i,), }" % (self.descr, nRows)
+        # magic (6) + version (2) + header length (2) + header, ending with a newline
+        header = header.ljust(self.HEADERSIZE - 11) + '\n'
+        if len(header) > self.HEADERSIZE - 10:
+            raise RuntimeError('too many stars for a %i byte npy header' % self.HEADERSIZE)
+        self.file.seek(0)
+        self.file.write(numpy.lib.format.magic(1, 0))
+        self.file.write(numpy.array(len(header), dtype = '<u2').tostring())
+        self.file.write(header)
+
+    def writeRows(self, photTable, start, stop):
+        self.file.seek(self.HEADERSIZE + self.nRows * self.rowType().itemsize)
+        self.file.write(self.rows(photTable, start, stop).tostring())
+        self.writeShape(self.nRows + stop - start)
+
+class CsvWriter(RowWriter):
+    """Write rows as comma separated text
+    """
+    def writeHeader(self):
+        names = ['DATE-OBS', 'EXPTIME']
+        if self.radii is None:
+            names += ['FLUX%i' % num for num in range(self.nStars)]
+        else:
+            names += ['FLUX%i_R%g' % (num, radius) for num in range(self.nStars) for radius in self.radii]
+        names += ['SKY%i' % num for num in range(self.nStars)]
+        names += ['XOFFSET', 'YOFFSET', 'FLAGS']
+        self.file.write(', '.join(names) + '\n')
+
+    def writeRows(self, photTable, start, stop):
+        for row in self.rows(photTable, start, stop):
+            values = [row['DATE-OBS'], '%f' % row['EXPTIME']]
+            values += ['%f' % value for value in row['FLUX'].ravel()]
+            values += ['%f' % value for value in row['SKY']]
+            values += ['%f' % value for value in row['OFFSET']]
+            values.append('%i' % row['FLAGS'])
+            self.file.write(', '.join(values) + '\n')
+
+WRITERS = {'fits': FitsWriter, 'npy': NpyWriter, 'csv': CsvWriter}
+
+def fileSafe(name):
+    """name (eg a filter) made safe to use in a file name
+    """
+    return ''.join(char if char.isalnum() or char in '-_+' else '_' for char in str(name))
+
+def fitsCard(key, value):
+    """an 80 character FITS header card
+    """
+    if isinstance(value, bool):
+        value = '%20s' % ('T' if value else 'F')
+    elif isinstance(value, str):
+        value = "'%-8s'" % value
+    elif isinstance(value, float):
+        value = '%20.10G' % value
+    else:
+        value = '%20i' % value
+    return ('%-8s= %s' % (key, value)).ljust(80)
+
+def fitsHeader(cards):
+    """join cards, add END and pad to a FITS block
+    """
+    header = ''.join(cards) + 'END'.ljust(80)
+    return header + ' ' * (-len(header) % img.FITSBLOCK)
@@ -8,17 +8,19 @@ defined with centers at n*(1-0.5) rather than n
 photometry set to nan if pyguide centroid is not ok--don't think it will ever
 be not ok, but whatever.
 
+scipy is imported where it's used, so worker processes that don't zoom (eg the 
+exact backend) never load it.
+
 """
 
 import numpy
-import scipy.ndimage as nd
-import matplotlib.pyplot as plt
 import itertools
 
 class PhotObj(object):
     """A class for holding the photometry information
     """
-    def __init__(self, countsInfo, skyInfo, img, center, radii, gridDense):
+    def __init__(self, countsInfo, skyInfo, img, center, radii, gridDense, skyWeights=None,
+                skyPartial=None):
         """Inputs:
         countsInfo: [counts, inds] vector containing all counts for partial pixels, inds 2d array with xy indices, shold be background subtracted
         skyInfo: [counts, inds] vector containing all sky values for partial pixels, inds 2d array with xy indices
@@ -26,6 +28,10 @@ class PhotObj(object):
         center: the determined center of the psf, scaled to match img
         radii: [aperture, innerSky, outerSky], in original pixel scaling
         gridDense: the gridDense factor used to create partial pixels
+        skyWeights: fractional area of each sky value inside the annulus, or None
+            if every value counts fully
+        skyPartial: the sky level of a partial pixel if it was already measured 
+            (eg by a skyLevel estimator other than the median), or None
         """
         self._counts = countsInfo[0]
         self._countsInds = countsInfo[1]
@@ -35,6 +41,8 @@ class PhotObj(object):
         self._img = img
         self._radii = radii
         self._gridDense = gridDense
+        self._skyWeights = skyWeights
+        self._skyPartial = skyPartial
 
     @property
     def counts(self):
@@ -51,41 +59,165 @@ class PhotObj(object):
     
     @property
     def skyPartial(self):
-        """median sky value of a partial pixel
+        """sky value of a partial pixel, the median unless measured otherwise
         """         
+        if self._skyPartial is not None:
+            return self._skyPartial
+        if self._skyWeights is not None:
+            return weightedMedian(self._sky, self._skyWeights)[0]
         return numpy.median(self._sky)
     
 
+class BatchPhotObj(object):
+    """A class for holding the photometry information for many stars at once,
+    as returned by ApPhot.batchDoIt.  Everything is stored as arrays indexed by star.
+    """
+    def __init__(self, counts, skyPartial, nPix, centers, gridDense):
+        """Inputs:
+        counts: N array of background subtracted counts, N x nRadii if photometry 
+            was done with a list of aperture radii
+        skyPartial: N array, sky value of a partial pixel
+        nPix: area of the aperture in original pixels, same shape as counts
+        centers: N x 2 array of xy centers photometry was done at
+        gridDense: the gridDense factor used to create partial pixels
+        """
+        self.counts = counts
+        self.skyPartial = skyPartial
+        self.nPix = nPix
+        self.centers = centers
+        self._gridDense = gridDense
+
+    def __len__(self):
+        return len(self.counts)
+
+    @property
+    def sky(self):
+        """Return the sky values, rescaled to match the level corresponding
+        to an original pixel (not a partial pixel).
+        """
+        return self.skyPartial * (self._gridDense**2)
+
+def weightedMedian(values, weights):
+    """Median along the last axis of values, where each value is counted weights times.
+    
+    For integer weights this is identical to numpy.median of the values repeated 
+    weights times (even totals average the two middle values), so it can stand in 
+    for a median taken over a densified grid.
+    
+    Inputs:
+    values: N x M array
+    weights: N x M array of non negative weights
+    
+    Returns:
+    N array of medians, nan where the weights sum to 0
+    """
+    values = numpy.atleast_2d(values)
+    weights = numpy.atleast_2d(weights)
+    sortInd = numpy.argsort(values, axis=1)
+    rowInd = numpy.arange(values.shape[0])[:,None]
+    sortedVals = values[rowInd, sortInd]
+    cumWeights = numpy.cumsum(weights[rowInd, sortInd], axis=1)
+    half = cumWeights[:,-1:] / 2.
+    # first values at which the cumulative weight reaches and passes the halfway point
+    lower = numpy.argmax(cumWeights >= half, axis=1)
+    upper = numpy.argmax(cumWeights > half, axis=1)
+    rowInd = rowInd[:,0]
+    median = 0.5 * (sortedVals[rowInd, lower] + sortedVals[rowInd, upper])
+    median[cumWeights[:,-1] <= 0] = numpy.nan
+    return median
+
+SKYMETHODS = ['median', 'sigclip', 'mode']
+SKYCLIP = 3. # sigma, for the 'sigclip' and 'mode' sky estimators
+SKYITER = 5 # maximum clipping iterations
+
+def skyLevel(values, weights=None, method='median'):
+    """Sky level along the last axis of values, by one of SKYMETHODS:
+    'median': the (weighted) median
+    'sigclip': mean after iteratively clipping values more than SKYCLIP standard 
+        deviations from the median
+    'mode': 2.5 median - 1.5 mean of the clipped values (as SExtractor), less 
+        biased by faint stars in the annulus
+    
+    Inputs:
+    values: N x M array, eg the native pixels of each star's region
+    weights: N x M array of non negative weights (how much of each pixel is in the
+        sky annulus), or None to count every value once
+    
+    Returns:
+    N array of sky levels, nan where the weights sum to 0
+    """
+    if method not in SKYMETHODS:
+        raise RuntimeError('sky method must be one of %s, got %s' % (SKYMETHODS, method))
+    values = numpy.atleast_2d(values)
+    if weights is None:
+        if method == 'median':
+            # numpy.median selects with numpy.partition, no full sort
+            return numpy.median(values, axis=1)
+        weights = numpy.ones(values.shape)
+    weights = numpy.atleast_2d(weights)
+    median = weightedMedian(values, weights)
+    if method == 'median':
+        return median
+    keep = weights
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        for iteration in range(SKYITER):
+            total = numpy.sum(keep, axis=1)
+            mean = numpy.sum(keep * values, axis=1) / total
+            std = numpy.sqrt(numpy.sum(keep * (values - mean[:,None])**2, axis=1) / total)
+            clipped = numpy.where(numpy.abs(values - median[:,None]) <= SKYCLIP * std[:,None], weights, 0)
+            if numpy.array_equal(clipped, keep):
+                break
+            keep = clipped
+            median = weightedMedian(values, keep)
+        mean = numpy.sum(keep * values, axis=1) / numpy.sum(keep, axis=1)
+    if method == 'sigclip':
+        return mean
+    return 2.5 * median - 1.5 * mean
+
+
+BATCHSIZE = 16 # number of stars densified at once by ApPhot.batchDoIt
+
 class ApPhot(object):
     """Object for doing aperture photometry
     """
     def __init__(self, data, inrad, skyAnnulus, 
-                gridDense=11, splineOrder=0):
+                gridDense=11, splineOrder=0, skyMethod='median'):
         """
-        data: 2d image array
+        data: 2d image array, or an img.FrameWindows holding the regions around 
+            the stars
         center: xy center of object (psf)
-        inrad: inner radius aperture
+        inrad: inner radius aperture, or a list of them to measure every star in 
+            several apertures at once (batchDoIt then returns counts per radius)
         skyAnnulus: (inner radius, outer radius)
         gridDense: increase grid density by this factor, determines number of partial
             pixels to be made
         splineOrder: order of the spline to fit to the upsampled image section.
                     0 = none.    
+        skyMethod: sky estimator, one of SKYMETHODS (see skyLevel)
         """
         self.data = data
         if gridDense % 2 == 0:
             gridDense += 1 # I told you it must be odd.
         self.inrad = inrad 
+        self.radii = numpy.atleast_1d(numpy.asarray(inrad, dtype=float))
         self.skyAnnulus = skyAnnulus 
         self.gridDense = gridDense
         self.splineOrder = splineOrder
+        self.skyMethod = skyMethod
     
-    def fuckinDoIt(self, center):
+    def fuckinDoIt(self, center, inrad=None, region=None):
         """Do aperture photmetry around a center point, return a photObj
+        inrad: aperture radius, default the first of self.radii
+        region: the _regionExtract square around center if it's already cut out 
+            (eg from _regionCube, which also works on img.FrameWindows), or None
         """
+        if inrad is None:
+            inrad = self.radii[0]
         center = numpy.asarray(center)
-        # keep only region of image centered around object of square length about
-        # the outer annulus
-        region = self._regionExtract(center)
+        if region is None:
+            # keep only region of image centered around object of square length about
+            # the outer annulus
+            region = self._regionExtract(center)
         # create a denser version for partial pixel emulation
         denseData = self._denseify(region)
         # center in new coordinates
@@ -97,18 +229,192 @@ class ApPhot(object):
         skyInfo = self.radialExtract(denseData, denseCenter, 
                                             self.skyAnnulus[1] * self.gridDense,
                                             self.skyAnnulus[0] * self.gridDense)
-        # determine median sky value and subtract
-        skyLevel = numpy.median(skyInfo[0])
-        denseNoSky = denseData - skyLevel
+        # determine sky value and subtract
+        if self.splineOrder or region.shape != (2*self._boxSize() + 1,)*2:
+            skyPartial = skyLevel(skyInfo[0], method=self.skyMethod)[0]
+        else:
+            # the dense sky pixels are copies of the native ones, measure those 
+            # weighted by the area of each inside the annulus instead
+            regionCenter = self._boxSize() - (numpy.round(center) - center)
+            skyWeights = self._skyWeights(regionCenter[None,:], region.shape[0])
+            skyPartial = skyLevel(region.reshape(1, -1) / float(self.gridDense**2), 
+                skyWeights.reshape(1, -1), self.skyMethod)[0]
+        denseNoSky = denseData - skyPartial
         countsInfo = self.radialExtract(denseNoSky, denseCenter, 
-                                        self.inrad * self.gridDense)
+                                        inrad * self.gridDense)
         return PhotObj(countsInfo = countsInfo, 
                         skyInfo = skyInfo, 
                         img = denseNoSky, 
                         center = denseCenter, 
-                        radii = [self.inrad, self.skyAnnulus[0], self.skyAnnulus[1]], 
-                        gridDense = self.gridDense)
+                        radii = [inrad, self.skyAnnulus[0], self.skyAnnulus[1]], 
+                        gridDense = self.gridDense,
+                        skyPartial = skyPartial)
+        
+    def batchDoIt(self, centers):
+        """Do aperture photometry around many center points in one pass, return a 
+        BatchPhotObj.
         
+        centers: N x 2 array of xy centers, same convention as fuckinDoIt
+        
+        All regions are stacked into an N x k x k cube.  With splineOrder = 0 the
+        densified grid is just repeated original pixels, so instead of building it
+        the dense aperture masks are folded back onto the original pixels as 
+        integer weights (how many partial pixels each one contributes), and the 
+        sky is measured on the original pixels weighted by their area in the 
+        annulus.  Counts and sky are then weighted sums/sky levels over the cube, 
+        identical to what fuckinDoIt measures.  Stars whose region falls off the 
+        image get nan.
+
+        With a list of aperture radii every radius is measured from the same 
+        cutout and sky, counts are N x nRadii.
+        """
+        centers = numpy.atleast_2d(numpy.asarray(centers, dtype=float))
+        nStars = len(centers)
+        counts = numpy.zeros((nStars, len(self.radii))) + numpy.nan
+        skyPartial = numpy.zeros(nStars) + numpy.nan
+        nPix = numpy.zeros((nStars, len(self.radii))) + numpy.nan
+        cube, inside = self._regionCube(centers)
+        if self.splineOrder:
+            # smoothed dense grids are not repeated pixels, do them one by one
+            for ind, center in enumerate(centers):
+                if not inside[ind]:
+                    continue
+                for radInd, inrad in enumerate(self.radii):
+                    photObj = self.fuckinDoIt(center, inrad, region=cube[ind])
+                    counts[ind, radInd] = photObj.counts
+                    nPix[ind, radInd] = len(photObj._counts) / float(self.gridDense**2)
+                skyPartial[ind] = photObj.skyPartial
+            return self._batchPhotObj(counts, skyPartial, nPix, centers)
+        # divide as _denseify does, so partial pixel values match exactly
+        cube = cube / float(self.gridDense**2)
+        # centers in densified region coordinates, as in _getNewCent
+        denseSize = len(self._denseIndex(cube.shape[1]))
+        denseCenters = numpy.floor(denseSize/2.) - (numpy.round(centers) - centers)*self.gridDense
+        regionCenters = self._boxSize() - (numpy.round(centers) - centers)
+        for start in range(0, nStars, BATCHSIZE):
+            batch = slice(start, start + BATCHSIZE)
+            apWeights = self._denseWeights(denseCenters[batch], cube.shape[1])
+            skyWeights = self._skyWeights(regionCenters[batch], cube.shape[1])
+            values = cube[batch].reshape(len(skyWeights), -1)
+            skyPartial[batch] = skyLevel(values, skyWeights.reshape(values.shape), self.skyMethod)
+            apWeights = apWeights.reshape(values.shape[:1] + (len(self.radii),) + values.shape[1:])
+            nDense = numpy.sum(apWeights, axis=2)
+            counts[batch] = numpy.einsum('nrp,np->nr', apWeights, values) - skyPartial[batch,None] * nDense
+            nPix[batch] = nDense / float(self.gridDense**2)
+        counts[~inside] = numpy.nan
+        skyPartial[~inside] = numpy.nan
+        return self._batchPhotObj(counts, skyPartial, nPix, centers)
+
+    def _batchPhotObj(self, counts, skyPartial, nPix, centers):
+        """BatchPhotObj from N x nRadii counts and nPix, which are flattened to N 
+        if inrad was a single radius
+        """
+        if numpy.ndim(self.inrad) == 0:
+            counts = counts[:,0]
+            nPix = nPix[:,0]
+        return BatchPhotObj(counts, skyPartial, nPix, centers, self.gridDense)
+
+    def _regionCube(self, centers):
+        """Extract the _regionExtract square around each center into an N x k x k cube.
+        
+        returns
+        cube: the stacked regions
+        inside: N boolean array, False where a region runs off the image (its 
+            pixels are clipped to the edge and should not be trusted)
+        """
+        boxSize = self._boxSize()
+        centerPix = numpy.round(centers).astype(int)
+        if hasattr(self.data, 'regionCube'):
+            # data is only windows around the stars (img.FrameWindows)
+            return self.data.regionCube(centerPix, boxSize)
+        boxRng = numpy.arange(-boxSize, boxSize+1)
+        rows = centerPix[:,1,None] + boxRng
+        cols = centerPix[:,0,None] + boxRng
+        inside = (rows[:,0] >= 0) & (rows[:,-1] < self.data.shape[0]) & \
+                    (cols[:,0] >= 0) & (cols[:,-1] < self.data.shape[1])
+        rows = numpy.clip(rows, 0, self.data.shape[0]-1)
+        cols = numpy.clip(cols, 0, self.data.shape[1]-1)
+        # note x,y reversal, as in _regionExtract
+        cube = self.data[rows[:,:,None], cols[:,None,:]]
+        return cube, inside
+
+    def _boxSize(self):
+        """half width of the square regions extracted around each star
+        """
+        boxSize = self.skyAnnulus[1]
+        # box must have odd size length, so there is always 1 center pixel
+        if self.skyAnnulus[1] % 2 == 0:
+            boxSize = boxSize + 1
+        return boxSize
+
+    def _denseIndex(self, regionSize):
+        """For a region of side regionSize, return the original pixel index each
+        partial pixel of the _denseify'd region was copied from (along one axis).
+        """
+        # zoom an index ramp the same way _denseify zooms the data, so the
+        # mapping always agrees with it
+        import scipy.ndimage as nd
+        return numpy.round(nd.zoom(numpy.arange(regionSize, dtype=float), self.gridDense, 
+                                order=0, prefilter=False)).astype(int)
+
+    def _denseWeights(self, denseCenters, regionSize):
+        """Fold the dense aperture masks for each center back onto the original 
+        pixels of the region.
+        
+        Inputs:
+        denseCenters: N x 2 centers in densified region coordinates (see _getNewCent)
+        regionSize: side length of the original (not densified) region
+        
+        Returns:
+        apWeights: N x nRadii x regionSize x regionSize array holding how many partial 
+            pixels of each original pixel fall in each aperture
+        """
+        # radialExtract only looks at the first shape-1 dense pixels
+        denseInd = self._denseIndex(regionSize)[:-1]
+        daRng = numpy.arange(len(denseInd))
+        # partial pixels copied from the same original pixel are contiguous, 
+        # sum over each run of them
+        runStarts = numpy.flatnonzero(numpy.r_[True, denseInd[1:] != denseInd[:-1]])
+        runInds = denseInd[runStarts]
+        xOff = daRng - denseCenters[:,0,None]
+        yOff = daRng - denseCenters[:,1,None]
+        dist = numpy.sqrt(xOff[:,None,:]**2 + yOff[:,:,None]**2) # N x y x x
+        def fold(mask):
+            # number of partial pixels of each original pixel in mask
+            colSums = numpy.add.reduceat(mask.view(numpy.int8), runStarts, axis=2, dtype=numpy.int32)
+            runSums = numpy.add.reduceat(colSums, runStarts, axis=1)
+            weight = numpy.zeros((len(dist), regionSize, regionSize))
+            weight[:, runInds[:,None], runInds] = runSums
+            return weight
+        # every aperture from the same distances
+        apWeights = numpy.asarray([fold(dist <= radius * self.gridDense) for radius in self.radii])
+        return apWeights.transpose(1, 0, 2, 3)
+
+    def _circleWeights(self, regionCenters, regionSize, radius):
+        """Area of each pixel of a region inside a circle about each center
+        
+        Inputs:
+        regionCenters: N x 2 centers in region coordinates (pixel centers are integers)
+        regionSize: side length of the region
+        radius: circle radius, pixels
+        
+        Returns:
+        N x regionSize x regionSize array of overlap areas
+        """
+        # pixel edges relative to each center
+        edges = numpy.arange(regionSize + 1) - 0.5
+        xEdges = edges - regionCenters[:,0,None]
+        yEdges = edges - regionCenters[:,1,None]
+        # area of the circle below and left of every pair of edges, difference 
+        # the corners to get the area in each pixel
+        corners = cornerArea(xEdges[:,None,:], yEdges[:,:,None], radius) # N x y x x
+        return corners[:,1:,1:] - corners[:,1:,:-1] - corners[:,:-1,1:] + corners[:,:-1,:-1]
+
+    def _skyWeights(self, regionCenters, regionSize):
+        """Area of each pixel of a region inside the sky annulus, see _circleWeights
+        """
+        return self._circleWeights(regionCenters, regionSize, self.skyAnnulus[1]) - \
+            self._circleWeights(regionCenters, regionSize, self.skyAnnulus[0])
         
 
     def _getNewCent(self, oldCenter, interpData):
@@ -136,11 +442,12 @@ class ApPhot(object):
             to center. Sidelength is odd and equal to self.skyAnnulus[1] or
             self.skyAnnulus[1]+1 (whichever is odd)
         """
-        boxSize = self.skyAnnulus[1]
-        # box must have odd size length, so there is always 1 center pixel
-        if self.skyAnnulus[1] % 2 == 0:
-            boxSize = boxSize + 1
-        centerPix = numpy.round(center) # pixel closest to psf center
+        boxSize = self._boxSize()
+        centerPix = numpy.round(center).astype(int) # pixel closest to psf center
+        if hasattr(self.data, 'regionCube'):
+            # data is only windows around the stars (img.FrameWindows), nan if 
+            # none holds the region
+            return self.data.regionCube(centerPix[None,:], boxSize)[0][0]
         # get region of image centered on centerPix, of size (boxSize, boxSize)
         # note x,y reversal, it works.
         region = self.data[centerPix[1]-boxSize:centerPix[1]+boxSize+1, centerPix[0]-boxSize:centerPix[0]+boxSize+1]
@@ -158,6 +465,7 @@ class ApPhot(object):
         returns: 
         denseData: the upsampled (and possibly interpolated) data 
         """ 
+        import scipy.ndimage as nd # only loaded when photometry is done
         denseData = nd.zoom(region, self.gridDense, order=self.splineOrder, prefilter=False)
         # grid is higher density so must renormalize so each pixel counts for less
         denseData = denseData/(self.gridDense**2) 
@@ -216,64 +524,323 @@ class ApPhot(object):
         values
         
         
+class ExactApPhot(ApPhot):
+    """Object for doing aperture photometry using the exact overlap of each original 
+    pixel with the aperture and sky annulus, rather than partial pixels.  Nothing
+    is densified, so gridDense and splineOrder are ignored.
+    """
+    def __init__(self, data, inrad, skyAnnulus, gridDense=1, splineOrder=0, skyMethod='median'):
+        ApPhot.__init__(self, data, inrad, skyAnnulus, gridDense=1, splineOrder=0, skyMethod=skyMethod)
+
+    def fuckinDoIt(self, center, inrad=None, region=None):
+        """Do aperture photmetry around a center point, return a photObj
+        inrad: aperture radius, default the first of self.radii
+        region: the _regionExtract square around center if it's already cut out, 
+            or None
+        """
+        if inrad is None:
+            inrad = self.radii[0]
+        center = numpy.asarray(center, dtype=float)
+        if region is None:
+            region = self._regionExtract(center)
+        # center in region coordinates
+        regionCenter = self._boxSize() - (numpy.round(center) - center)
+        skyWeights = self._skyWeights(regionCenter[None,:], region.shape[0])
+        skyInds = numpy.nonzero(skyWeights[0])
+        skyPartial = skyLevel(region[skyInds], skyWeights[0][skyInds], self.skyMethod)[0]
+        noSky = region - skyPartial
+        # weights for just the radius asked for, which needn't be one of self.radii
+        apWeights = self._circleWeights(regionCenter[None,:], region.shape[0], inrad)[0]
+        countsInds = numpy.nonzero(apWeights)
+        return PhotObj(countsInfo = [noSky[countsInds] * apWeights[countsInds], countsInds], 
+                        skyInfo = [region[skyInds], skyInds], 
+                        img = noSky, 
+                        center = regionCenter, 
+                        radii = [inrad, self.skyAnnulus[0], self.skyAnnulus[1]], 
+                        gridDense = 1,
+                        skyWeights = skyWeights[0][skyInds],
+                        skyPartial = skyPartial)
+
+    def batchDoIt(self, centers):
+        """Do aperture photometry around many center points in one pass, return a 
+        BatchPhotObj.
+        
+        centers: N x 2 array of xy centers, same convention as fuckinDoIt
+        """
+        centers = numpy.atleast_2d(numpy.asarray(centers, dtype=float))
+        cube, inside = self._regionCube(centers)
+        regionCenters = self._boxSize() - (numpy.round(centers) - centers)
+        skyWeights, apWeights = self._overlapWeights(regionCenters, cube.shape[1])
+        values = cube.reshape(len(cube), -1)
+        skyPartial = skyLevel(values, skyWeights.reshape(values.shape), self.skyMethod)
+        apWeights = apWeights.reshape(values.shape[:1] + (len(self.radii),) + values.shape[1:])
+        nPix = numpy.sum(apWeights, axis=2)
+        counts = numpy.einsum('nrp,np->nr', apWeights, values) - skyPartial[:,None] * nPix
+        counts[~inside] = numpy.nan
+        skyPartial[~inside] = numpy.nan
+        return self._batchPhotObj(counts, skyPartial, nPix, centers)
+
+    def _overlapWeights(self, regionCenters, regionSize):
+        """Fraction of each pixel of a region inside the sky annulus and the aperture
+        
+        Inputs:
+        regionCenters: N x 2 centers in region coordinates (pixel centers are integers)
+        regionSize: side length of the region
+        
+        Returns:
+        skyWeights: N x regionSize x regionSize array of overlap areas with the annulus
+        apWeights: N x nRadii x regionSize x regionSize, overlap areas with each aperture
+        """
+        skyWeights = self._skyWeights(regionCenters, regionSize)
+        apWeights = numpy.asarray([self._circleWeights(regionCenters, regionSize, radius) 
+            for radius in self.radii]).transpose(1, 0, 2, 3)
+        return skyWeights, apWeights
+
+def cornerArea(x, y, radius):
+    """Signed area of the part of a circle (centered at 0,0) that lies inside the
+    rectangle with corners (0,0) and (x,y).  Negative when exactly one of x, y is
+    negative, so differencing corners gives the overlap of any rectangle with the circle.
+    """
+    if radius <= 0:
+        return numpy.zeros(numpy.broadcast(x, y).shape)
+    absX = numpy.minimum(numpy.abs(x), radius)
+    absY = numpy.minimum(numpy.abs(y), radius)
+    # x where the circle crosses the top of the rectangle
+    xCross = numpy.minimum(numpy.sqrt(radius**2 - absY**2), absX)
+    def chordArea(xx):
+        # area under the circle between 0 and xx
+        return 0.5 * (xx * numpy.sqrt(radius**2 - xx**2) + radius**2 * numpy.arcsin(xx / radius))
+    area = xCross * absY + chordArea(absX) - chordArea(xCross)
+    return numpy.sign(x) * numpy.sign(y) * area
+
+BACKENDS = {
+    'dense': ApPhot, # partial pixels made by upsampling
+    'exact': ExactApPhot, # exact pixel/circle overlap
+    }
+
 class DiffPhotObj(object):
     """An object containing differential photometry information
     """
-    def __init__(self, img, targCentroid, compCentroids, inrad, skyAnnulus, resolution, spline):
+    def __init__(self, img, targCentroid, compCentroids, inrad, skyAnnulus, resolution, spline, 
+                backend='dense', data=None, skyMethod='median', keepPhotObjs=False):
         """inputs:
         img: a baseImg or subclass of
         targCentroid: PyGuide centoid object for target star
         compCoords: list of PyGuide centroid objects for comparison stars
+        inrad: aperture radius, or a list of them, then counts are nStars x nRadii
+        backend: photometry backend, a key of BACKENDS
+        data: image data to use instead of img.data (eg an img.FrameWindows), or None
+        skyMethod: sky estimator, one of SKYMETHODS
+        keepPhotObjs: if True also measure each star on its own (ApPhot.fuckinDoIt, 
+            first aperture radius) into targPhot and compPhot, the PhotObjs the 
+            viz diagnostics plot.  Otherwise they are None
         """
         self.img = img
         self.targCentroid = targCentroid # PyGuide centriod
         self.compCentroids = compCentroids # list of PyGuide centroids
-        apPhot = ApPhot(
-            data = img.data, 
+        apPhot = BACKENDS[backend](
+            data = img.data if data is None else data, 
             inrad = inrad,
             skyAnnulus = skyAnnulus,
             gridDense = resolution,
-            splineOrder = spline)
-        # do photometry for target, offset pyguide to 0,0.
-        if self.targCentroid.isOK:
-            self.targPhot = apPhot.fuckinDoIt(numpy.asarray(self.targCentroid.xyCtr) - 0.5)
+            splineOrder = spline,
+            skyMethod = skyMethod)
+        # do photometry for target and comparisons in one batch, offset pyguide to 0,0.
+        # photometry set to nan for stars PyGuide didn't find.
+        centroids = [self.targCentroid] + list(self.compCentroids)
+        self.isOK = numpy.asarray([cent.isOK for cent in centroids], dtype=bool)
+        self.counts = numpy.zeros((len(centroids),) + numpy.shape(inrad)) + numpy.nan
+        self.sky = numpy.zeros(len(centroids)) + numpy.nan
+        if numpy.any(self.isOK):
+            centers = numpy.asarray([cent.xyCtr for cent in centroids if cent.isOK]) - 0.5
+            self.photometry = apPhot.batchDoIt(centers)
+            self.counts[self.isOK] = self.photometry.counts
+            self.sky[self.isOK] = self.photometry.sky
         else:
-            self.targPhot = None
-        self.compPhot = []
-        for comp in self.compCentroids:
-            if comp.isOK:
-                self.compPhot.append(apPhot.fuckinDoIt(numpy.asarray(comp.xyCtr) - 0.5))
-            else:
-                self.compPhot.append(None)
+            self.photometry = None
+        photObjs = [None] * len(centroids)
+        if keepPhotObjs:
+            photObjs = [apPhot.fuckinDoIt(numpy.asarray(cent.xyCtr) - 0.5) if cent.isOK else None 
+                            for cent in centroids]
+        self.targPhot = photObjs[0]
+        self.compPhot = photObjs[1:]
 
     @property
     def targCounts(self):
-        """photometry extracted target counts, normalized by exposure time
+        """photometry extracted target counts, normalized by exposure time (an array 
+        per aperture radius if there are several)
         Returns numpy.nan if no object was found by PyGuide at the specified location
         """
-        if self.targPhot: # targPhot = None if pyguide centroid is not ok
-            return self.targPhot.counts/self.img.exptime
-        else:
-            return numpy.nan
+        return self.counts[0]/self.img.exptime
         
     @property
     def compCounts(self):
         """photometry extracted array of comparision counts, normalized by exposure time
         Returns numpy.nan if no object was found by PyGuide at the specified location
         """
-        out = []
-        for comp in self.compPhot:
-            if comp: # comp=None if pyguide centroid is not ok.
-                out.append(comp.counts/self.img.exptime)
-            else: 
-                out.append(numpy.nan)
-        return out
+        return list(self.counts[1:]/self.img.exptime)
         
     @property
     def diffCounts(self):
         """return the target counts normalized by the comparison counts summed
         """
-        return self.targCounts / numpy.sum(self.compCounts)
+        return self.targCounts / numpy.sum(self.compCounts, axis=0)
                                      
                 
-        
\ No newline at end of file
+        
+class PhotTable(object):
+    """Differential photometry results for a series of images, one row per image, 
+    kept as preallocated columns (which grow as needed) rather than as a list of 
+    DiffPhotObjs.  Star 0 is the target, the rest are comparisons.
+
+    columns (each sliced to the rows filled, index by row):
+    path: image file path
+    dateObs: date of observation, numpy datetime64
+    exptime: exposure time
+    counts: nRows x nStars sky subtracted counts (not exposure time normalized), 
+        nRows x nStars x nRadii if photometry was done in several apertures
+    sky: nRows x nStars sky level per pixel
+    centroids: nRows x nStars x 2 PyGuide [x,y] centroids, nan where not found
+    offset: nRows x 2 offset of the field from the reference image
+    rotation: nRows x 2 x 2 rotation (and flip) of the field from the reference image
+    flags: bitwise or of the FLAG values below
+    """
+    FLAG_HASHED = 1 # the field had to be hashed to find the stars
+    FLAG_MISSING = 2 # one or more stars weren't centroided
+
+    def __init__(self, nStars, size=64, radii=None):
+        """inputs:
+        nStars: number of stars, target plus comparisons
+        size: number of rows to preallocate, eg the number of images
+        radii: the aperture radius, or a list of them (PhotConfig.inrad)
+        """
+        self.nStars = nStars
+        self.radii = None if radii is None or numpy.ndim(radii) == 0 else list(radii)
+        self.nRows = 0
+        self._columns = dict((name, numpy.zeros((max(size, 1),) + shape, dtype=dtype)) 
+            for name, dtype, shape in self._columnSpec())
+
+    def _columnSpec(self):
+        """[(name, dtype, per row shape), ...]
+        """
+        return [
+            ('path', object, ()),
+            ('dateObs', 'datetime64[us]', ()),
+            ('exptime', float, ()),
+            ('counts', float, (self.nStars,) + self._radiusShape()),
+            ('sky', float, (self.nStars,)),
+            ('centroids', float, (self.nStars, 2)),
+            ('offset', float, (2,)),
+            ('rotation', float, (2, 2)),
+            ('flags', int, ()),
+        ]
+
+    def _radiusShape(self):
+        """per star shape of counts, () for a single aperture
+        """
+        return () if self.radii is None else (len(self.radii),)
+
+    def __getattr__(self, name):
+        if not name.startswith('_') and name in self._columns:
+            return self._columns[name][:self.nRows]
+        raise AttributeError("'PhotTable' object has no attribute '%s'" % name)
+
+    def __len__(self):
+        return self.nRows
+
+    def _reserve(self, nRows):
+        """make sure there's room for nRows, doubling the allocation as needed
+        """
+        size = len(self._columns['flags'])
+        if nRows <= size:
+            return
+        while size < nRows:
+            size *= 2
+        for name, column in self._columns.items():
+            grown = numpy.zeros((size,) + column.shape[1:], dtype=column.dtype)
+            grown[:self.nRows] = column[:self.nRows]
+            self._columns[name] = grown
+
+    def append(self, diffPhotObj, transform, flags=0):
+        """add a row
+        inputs:
+        diffPhotObj: the DiffPhotObj for the image
+        transform: triangleHash.FieldTransform from the reference image to the image
+        flags: FLAG_ values, FLAG_MISSING is set here if needed
+        """
+        img = diffPhotObj.img
+        centroids = [diffPhotObj.targCentroid] + list(diffPhotObj.compCentroids)
+        if not numpy.all(diffPhotObj.isOK):
+            flags |= self.FLAG_MISSING
+        self.appendRow(dict(
+            path = img.path,
+            dateObs = numpy.datetime64(img.dateObs, 'us'),
+            exptime = img.exptime,
+            counts = diffPhotObj.counts,
+            sky = diffPhotObj.sky,
+            centroids = [cent.xyCtr if cent.isOK else (numpy.nan, numpy.nan) for cent in centroids],
+            offset = transform.offset,
+            rotation = transform.rotation,
+            flags = flags,
+            ))
+
+    def appendRow(self, row):
+        """add a row given as {column name: value}, as returned by row
+        """
+        self._reserve(self.nRows + 1)
+        for name, column in self._columns.items():
+            column[self.nRows] = row[name]
+        self.nRows += 1
+
+    def row(self, ind):
+        """row ind as {column name: value} with plain python values (lists, floats,
+        an ISO date string), eg for json
+        """
+        row = dict((name, getattr(self, name)[ind].tolist()) for name in self._columns
+            if name not in ['path', 'dateObs'])
+        row['path'] = self.path[ind]
+        row['dateObs'] = str(self.dateObs[ind])
+        return row
+
+    def extend(self, other):
+        """append all rows of another PhotTable
+        """
+        if other.nStars != self.nStars:
+            raise RuntimeError('cannot join tables of %i and %i stars' % (self.nStars, other.nStars))
+        if other.radii != self.radii:
+            raise RuntimeError('cannot join tables of apertures %s and %s' % (self.radii, other.radii))
+        self._reserve(self.nRows + other.nRows)
+        for name, column in self._columns.items():
+            column[self.nRows:self.nRows + other.nRows] = getattr(other, name)
+        self.nRows += other.nRows
+
+    @property
+    def times(self):
+        """dateObs as python datetime objects
+        """
+        return self.dateObs.astype(object)
+
+    @property
+    def targCounts(self):
+        """target counts normalized by exposure time, nan where not found. nRows x 
+        nRadii for several apertures, as are compCounts' rows and diffCounts
+        """
+        return self.counts[:,0] / self._perRow(self.exptime, 1)
+
+    @property
+    def compCounts(self):
+        """nRows x nComparisons comparison counts normalized by exposure time
+        """
+        return self.counts[:,1:] / self._perRow(self.exptime, 2)
+
+    @property
+    def diffCounts(self):
+        """target counts normalized by the comparison counts summed
+        """
+        return self.targCounts / numpy.sum(self.compCounts, axis=1)
+
+    def _perRow(self, column, ndim):
+        """a 1d column reshaped to broadcast against nRows x ... arrays of ndim
+        dimensions (besides the radius axis)
+        """
+        return column.reshape((-1,) + (1,) * (ndim - 1 + len(self._radiusShape())))
@@ -17,20 +17,90 @@ BUG:
 """
 
 import numpy
-import PyGuide
 import numpy.linalg
 import itertools
 
 
+class FieldTransform(object):
+    """A rigid transform (rotation, possibly with a flip, and translation) taking 
+    coordinates in the reference image to coordinates in another image:
+        xyOther = rotation . xyRef + translation
+    """
+    def __init__(self, rotation=None, translation=None):
+        """Inputs:
+        rotation: 2x2 orthogonal matrix (determinant -1 if flipped), default no rotation
+        translation: xy translation, default none
+        """
+        self.rotation = numpy.eye(2) if rotation is None else numpy.asarray(rotation, dtype=float)
+        self.translation = numpy.zeros(2) if translation is None else numpy.asarray(translation, dtype=float)
+
+    @classmethod
+    def fromOffset(cls, offset):
+        """a pure translation, where xyOther = xyRef - offset
+        """
+        return cls(translation = -numpy.asarray(offset, dtype=float))
+
+    def apply(self, coords):
+        """Map an xy position (or n x 2 array of them) from the reference image 
+        into the other image
+        """
+        return numpy.dot(numpy.asarray(coords, dtype=float), self.rotation.T) + self.translation
+
+    @property
+    def offset(self):
+        """xyRef - xyOther at the origin, the offset of a transform with no rotation
+        """
+        return -self.translation
+
+    @property
+    def angle(self):
+        """rotation angle in degrees
+        """
+        return numpy.degrees(numpy.arctan2(self.rotation[1, 0], self.rotation[0, 0]))
+
+    @property
+    def flipped(self):
+        return numpy.linalg.det(self.rotation) < 0
+
+    def __repr__(self):
+        return 'FieldTransform(offset=%s, angle=%.3f, flipped=%s)' % (self.offset, self.angle, self.flipped)
+
+def fitTransform(refCoords, otherCoords, allowFlip=True):
+    """Least squares rigid transform taking refCoords onto otherCoords
+    Inputs:
+    refCoords: n x 2 array of positions in the reference image
+    otherCoords: n x 2 array of the same stars' positions in the other image
+    allowFlip: if True the rotation may include a flip (reflection)
+    
+    Output:
+    a FieldTransform
+    """
+    refMean = numpy.mean(refCoords, 0)
+    otherMean = numpy.mean(otherCoords, 0)
+    cov = numpy.dot((refCoords - refMean).T, otherCoords - otherMean)
+    U, S, Vt = numpy.linalg.svd(cov)
+    rotation = numpy.dot(Vt.T, U.T)
+    if not allowFlip and numpy.linalg.det(rotation) < 0:
+        Vt[-1] *= -1
+        rotation = numpy.dot(Vt.T, U.T)
+    return FieldTransform(rotation, otherMean - numpy.dot(rotation, refMean))
+
 class TriangleHash(object):
     """An object representing a bunch of triangles
     """
-    def __init__(self, coordList):
+    def __init__(self, coordList, allowFlip=True, matchTol=2, minAgree=None):
         """Inputs:
         - coordList     - a 2d numpy array xy positions of found stars 
             on ccd (output from PyGuide.findStars)
+        - allowFlip     - if True solutions may be flipped (eg after a meridian flip)
+        - matchTol      - pixels, stars closer than this agree with a solution
+        - minAgree      - hashItOut stops as soon as this many stars agree with a
+            solution.  None for half of the stars (at least 3)
         """
-        self.coordList = coordList
+        self.coordList = numpy.asarray(coordList, dtype=float)
+        self.allowFlip = allowFlip
+        self.matchTol = matchTol
+        self.minAgree = minAgree
 #         self.verts = None
 #         self.triSpace = None
         self.setup()
@@ -38,47 +108,36 @@ class TriangleHash(object):
         
     def arrangeVerts(self, verts):
         """Inputs:
-        verts - a 3x2 numpy array containing un-arranged triangle vertices
+        verts - a 3x2 numpy array containing un-arranged triangle vertices,
+            or an n x 3 x 2 array of many triangles
         
         Output:
-        a 3x2 numpy array with vertices arranged as so:
+        a 3x2 (or n x 3 x 2) numpy array with vertices arranged as so:
             A and B define the
             shortest side, B and C the longest side, and A and C define
             the intermediate length side
         """
-        # moves last element to front, shifts rest
-        vertsShifted = numpy.roll(verts, 1, axis=0) 
+        verts = numpy.asarray(verts, dtype=float)
+        triVerts = verts.reshape(-1, 3, 2)
+        # moves last vertex to front, shifts rest
+        vertsShifted = numpy.roll(triVerts, 1, axis=1) 
         # compute distances
-        dist = numpy.sqrt(numpy.sum( (verts - vertsShifted)**2 ,1) )
+        dist = numpy.sqrt(numpy.sum( (triVerts - vertsShifted)**2 , 2) )
         # match up between shifted and unshifted vertices, the way distances were determined
         indMap = numpy.array([ [0, 2], [1, 0], [2, 1] ]) 
-        distSortInd = numpy.argsort(dist) # returns indices to sort by
-        sortedPairs = indMap[distSortInd, :] # sorted pairs, increasing distance
-        
-        # find vertex between short and medium length side: A
-        oneOf = sortedPairs[0:2, :] # shortest 2 lengths.  Common index will be A
-        uniqueInds, allInds = numpy.unique(oneOf, return_inverse = True)
-        # whats going on here?    
-#         >>> g
-#         array([[0, 1],
-#                [1, 2]])
-#         >>> numpy.unique(g, return_inverse=True)
-#         (array([0, 1, 2]), array([0, 1, 1, 2]))
-#       the difference in the sum of both of these arrays is 1 (the repeated number)
-        AInd = numpy.sum(allInds) - numpy.sum(uniqueInds)
-        A = verts[AInd]
+        distSortInd = numpy.argsort(dist, axis=1) # returns indices to sort by
+        sortedPairs = indMap[distSortInd] # sorted pairs, increasing distance
         
+        # A is the vertex shared by the short and medium length sides, 
+        # ie the one not on the longest side. Possible Inds = [0, 1, 2], sum is three
+        AInd = 3 - numpy.sum(sortedPairs[:, 2, :], 1)
         # B vertex will connect with A to make the short side
-        shortSide = sortedPairs[0, :] # shortest side indices, contains AInd
-        BInd = numpy.sum(shortSide) - AInd # sum and subtract AInd to reveal BInd
-        B = verts[BInd]
-        
+        BInd = numpy.sum(sortedPairs[:, 0, :], 1) - AInd
         # C vertex is the only remaining
-        # possible Inds = [0, 1, 2], sum is three
         CInd = 3 - (AInd + BInd)
-        C = verts[CInd]
-       
-        return numpy.vstack((A, B, C))
+        triInds = numpy.arange(len(triVerts))[:,None]
+        arranged = triVerts[triInds, numpy.column_stack((AInd, BInd, CInd))]
+        return arranged.reshape(verts.shape)
         
     def triangleMatch(self, triSpace1, triSpace2):
         """Match two sets of lists within a 2% tolerance that have been 
@@ -92,112 +151,89 @@ class TriangleHash(object):
         triSpace1 and triSpace2.
         
         note: more than 1 object may be matched to an object in triSpace2
-        and vice versa.  triangleVerify() will ultimitely decide the best
+        and vice versa.  hashItOut() will ultimitely decide the best
         matches in real space.
         """        
         tol = 0.02 # must match to 2 percent
+        maxMatches = 10
+        batchSize = 64 # triSpace1 triangles searched at once
+        if len(triSpace1) == 0 or len(triSpace2) == 0:
+            return numpy.zeros((0, 2), dtype=int)
+        # rank triangles by the product of x_t and y_t of each (most unique first)
+        byRank1 = numpy.argsort(triSpace1[:,0] * triSpace1[:,1])
+        byRank2 = numpy.argsort(triSpace2[:,0] * triSpace2[:,1])
+        rank2 = numpy.zeros(len(byRank2), dtype=int)
+        rank2[byRank2] = numpy.arange(len(byRank2))
+        # Matches are kept the way a search through every pair of triangles in rank 
+        # order stopping at more than 10 matches per triSpace1 triangle would: each 
+        # triSpace1 triangle keeps its matches (best ranked first) until there are 
+        # more than 10 in all, after that a triSpace1 triangle only keeps a match 
+        # with the first ranked triSpace2 triangle.  So every match is only looked 
+        # for until there are more than 10, a batch of triSpace1 triangles at a time.
+        ySort = numpy.argsort(triSpace2[:,1])
+        sortedY = triSpace2[ySort, 1]
         potentialMatches = []
-        # sort triangles by their product of x_t and y_t (most unique first)
-        triSort1 = numpy.argsort(triSpace1[:,0] * triSpace1[:,1])
-        triSort2 = numpy.argsort(triSpace2[:,0] * triSpace2[:,1])
-        
-        for ind1 in triSort1:
-            for ind2 in triSort2:
-                ratio = numpy.abs(1 - (triSpace1[ind1, :] / triSpace2[ind2, :]))
-                if numpy.max(ratio) < tol:
-                    potentialMatches.append([ind1, ind2])
-                if len(potentialMatches) > 10:
-                    break # if we have more than 10 potential triangles
-                    
-            # determine % variation between y_t values
-#             yratio = numpy.abs(1 - (tri1[1] / triSpace2[:, 1])) # abs because tol is +-2%
-#             tolInd = numpy.nonzero(yratio < tol) # keep only those which y_t tol < .02
-#             for ind2 in tolInd:
-#                 # now x_t must also be within 2%
-#                 print 'tri1.shape: ', tri1.shape, 'tri
-#                 xratio = numpy.abs(1 - (tri1[0] / triSpace2[ind2, 0]))
-#                 print 'xratio: ', xratio
-#                 if xratio < tol:
-#                     potentialMatches.append([ind1, ind2])
-                    
-                    
-                    
-        return numpy.asarray(potentialMatches)
-            
-    def triangleVerify(self, potentialMatches, triVert1, triVert2):
-        """Take potential matches from the triSpace matching done in triangleMatch()
-        and check to see if they match up in real space!
-        
-        Inputs: 
-        potentialMatches - output of triangleMatch
-        triVert1 - output of makeTriVerts() 3D array n x 3pts x 2coords
-        triVert2 - output of makeTriVerts() 3D array n x 3pts x 2coords
-        
-        Output:
-        n x 2 array with match indices between triVert1 and triVert2        
+        nFound = 0
+        start = 0
+        while start < len(byRank1) and nFound <= maxMatches:
+            batch = byRank1[start:start + batchSize]
+            start += len(batch)
+            # |1 - t1/t2| < tol  means t2 lies between t1/(1+tol) and t1/(1-tol), so 
+            # find candidates with a range query on the sorted y_t of triSpace2.  
+            # Bounds are padded a hair, the exact ratio test has the final say.
+            y1 = triSpace1[batch, 1]
+            pad = numpy.abs(y1) * 1e-9
+            lower = numpy.minimum(y1/(1+tol), y1/(1-tol)) - pad
+            upper = numpy.maximum(y1/(1+tol), y1/(1-tol)) + pad
+            first = numpy.searchsorted(sortedY, lower, side='left')
+            nCand = numpy.searchsorted(sortedY, upper, side='right') - first
+            group = numpy.repeat(numpy.arange(len(batch)), nCand)
+            # position of each candidate within sortedY
+            pos = numpy.arange(numpy.sum(nCand)) - numpy.repeat(numpy.cumsum(nCand) - nCand - first, nCand)
+            ind1 = batch[group]
+            ind2 = ySort[pos]
+            isMatch = self._ratioMatch(triSpace1[ind1], triSpace2[ind2], tol)
+            # batch is in rank order, put each triangle's matches in rank order too
+            order = numpy.lexsort((rank2[ind2[isMatch]], group[isMatch]))
+            ind1 = ind1[isMatch][order]
+            ind2 = ind2[isMatch][order]
+            group = group[isMatch][order]
+            groupStart = numpy.flatnonzero(numpy.r_[True, group[1:] != group[:-1]])
+            groupSize = numpy.diff(numpy.r_[groupStart, len(group)])
+            # matches of the triSpace1 triangles ranked before each one, kept or not
+            before = nFound + numpy.repeat(numpy.cumsum(groupSize) - groupSize, groupSize)
+            posInGroup = numpy.arange(len(group)) - numpy.repeat(groupStart, groupSize)
+            keep = numpy.where(before > maxMatches, (posInGroup == 0) & (rank2[ind2] == 0),
+                posInGroup <= maxMatches - before)
+            potentialMatches.append(numpy.column_stack((ind1[keep], ind2[keep])))
+            nFound += len(ind1)
+        # the rest only keep a match with the first ranked triSpace2 triangle
+        rest = byRank1[start:]
+        isMatch = self._ratioMatch(triSpace1[rest], triSpace2[byRank2[:1]], tol)
+        potentialMatches.append(numpy.column_stack((rest[isMatch], 
+            numpy.repeat(byRank2[:1], numpy.sum(isMatch)))))
+        return numpy.vstack(potentialMatches).astype(int)
+
+    def _ratioMatch(self, triSpace1, triSpace2, tol):
+        """True where triangles of triSpace1 match those of triSpace2 (paired up, or
+        broadcast) to within tol, see triangleMatch
         """
-        tol = 2 # pixels
-        tri1Matched = [] # holds indices already matched, can't be reused
-        tri2Matched = []
-        matched = []
-        for match in potentialMatches:
-            # check to see if either match is already assigned
-            if match[0] in tri1Matched or match[1] in tri2Matched:
-                continue
-            # normalize by vertex A
-            tri1 = triVert1[match[0], :, :] #2D
-            tri1 = tri1 - tri1[0, :]
-            tri2 = triVert2[match[1], :, :]
-            tri2 = tri2 - tri2[0, :]
-            diff = tri1 - tri2 # first vertex at 0,0 due to normalization
-            dist = numpy.sqrt(numpy.sum(diff**2, 1)) # distance between verts
-            if numpy.max(dist) < tol:
-                # both unnormalized vertices are less than our pixel tolerance
-                tri1Matched.append(match[0])
-                tri2Matched.append(match[1])
-                matched.append([match[0], match[1]])
-        #print 'returned best val: ', numpy.hstack((tri1Matched, tri2Matched))
-        return numpy.asarray(matched)
-        
-    def getOffset(self, verifiedMatches, triVert1, triVert2):
-        """Take verified matches from the triangleVerify() matching
-        
-        Inputs: 
-        verifiedMatches - output of triangleVerify()
-        triVert1 - output of makeTriVerts() 3D array n x 3pts x 2coords
-        triVert2 - output of makeTriVerts() 3D array n x 3pts x 2coords
-        
-        Output:
-        2 element array determining the offset to be applied       
-        """             
-        # just take the average offset of all for now
-        offsets = []
-        for match in verifiedMatches:
-            tri1 = triVert1[match[0], :, :]
-            tri2 = triVert2[match[1], :, :]
-            diff = numpy.subtract(tri1, tri2)
-            offsets.append(numpy.mean(diff, 0))
-        return numpy.mean(numpy.asarray(offsets), 0)
-                                  
+        return numpy.max(numpy.abs(1 - (triSpace1 / triSpace2)), axis=1) < tol
+
     def makeTriVerts(self, coordList):
         """Return a list of triangle Vertices, arranged by side length
         see: arrangeVerts()
         
         Output: 3D array
         """
-        triangles = map(self.arrangeVerts, itertools.combinations(coordList, 3))
-#         triangles = []
-#         old way, slightly slower:                            
-#         for ind1, coord1 in enumerate(self.coordList):
-#             for ind2, coord2 in enumerate(self.coordList):
-#                 if ind2 <= ind1: continue
-#                 for ind3, coord3 in enumerate(self.coordList):
-#                     if ind3 <= ind2: continue
-#                     ABC = self.arrangeVerts(numpy.array([coord1, coord2, coord3]))
-#                     triangles.append(ABC)
-
-        triangles = numpy.asarray(triangles) # 3D array
-        return triangles        
+        coordList = numpy.asarray(coordList, dtype=float)
+        if len(coordList) < 3:
+            return numpy.zeros((0, 3, 2))
+        # indices of every triple of coordinates, in itertools.combinations order
+        triInds = numpy.fromiter(
+            itertools.chain.from_iterable(itertools.combinations(range(len(coordList)), 3)),
+            dtype=int).reshape(-1, 3)
+        return self.arrangeVerts(coordList[triInds]) # 3D array
 
     def triangleSpace(self, triangles):
         """Create a output triangle space to search through
@@ -212,15 +248,13 @@ class TriangleHash(object):
             x_t = CB dot CA
             y_t = len(A) / len(C)
         """
-        out = []
-        for tri in triangles:
-            CA = tri[2] - tri[0]
-            CB = tri[2] - tri[1] # longest side
-            BA = tri[1] - tri[0] # shortest side
-            x_t = numpy.dot(CB, CA)
-            y_t = numpy.linalg.norm(CB) / numpy.linalg.norm(BA)
-            out.append(numpy.array([x_t, y_t]))
-        return numpy.asarray(out)
+        triangles = numpy.asarray(triangles, dtype=float).reshape(-1, 3, 2)
+        CA = triangles[:, 2] - triangles[:, 0]
+        CB = triangles[:, 2] - triangles[:, 1] # longest side
+        BA = triangles[:, 1] - triangles[:, 0] # shortest side
+        x_t = numpy.sum(CB * CA, 1)
+        y_t = numpy.sqrt(numpy.sum(CB**2, 1)) / numpy.sqrt(numpy.sum(BA**2, 1))
+        return numpy.column_stack((x_t, y_t))
 
     def setup(self):
         # hack for now to keep computations out of outer loop
@@ -231,13 +265,46 @@ class TriangleHash(object):
     # could move this work to a standalone object
     def hashItOut(self, coordList):
         """Take the current hash compare it with another, and return the 
-        determined offset
+        determined FieldTransform, taking reference coordinates to coordList's.
+        
+        Triangle matches are tried in rank order.  Each proposes the rigid transform 
+        between its vertices, which must fit the triangle itself within matchTol and
+        is then scored by how many reference stars land within matchTol of a star in
+        coordList.  The search stops as soon as enough stars agree (see minAgree), 
+        and the best transform is refit to all the stars agreeing with it.
+        Raises RuntimeError if no transform is agreed on by at least 3 stars.
         """
-        #self.setup()
+        coordList = numpy.asarray(coordList, dtype=float)
         otherVerts = self.makeTriVerts(coordList)
         otherTriSpace = self.triangleSpace(otherVerts)
-        #otherHash.setup() # ugh
         potentialMatches = self.triangleMatch(self.triSpace, otherTriSpace)
-        verifiedMatches = self.triangleVerify(potentialMatches, self.verts, otherVerts)
-        return self.getOffset(verifiedMatches, self.verts, otherVerts)
-            
\ No newline at end of file
+        minAgree = self.minAgree
+        if minAgree is None:
+            minAgree = max(3, min(len(self.coordList), len(coordList)) // 2)
+        bestPairs = numpy.zeros((0, 2), dtype=int)
+        for match in potentialMatches:
+            refTri = self.verts[match[0]]
+            otherTri = otherVerts[match[1]]
+            transform = fitTransform(refTri, otherTri, self.allowFlip)
+            triResid = numpy.sqrt(numpy.sum((transform.apply(refTri) - otherTri)**2, 1))
+            if numpy.max(triResid) > self.matchTol:
+                continue # not the same triangle in real space
+            pairs = self.agreeingStars(transform, coordList)
+            if len(pairs) > len(bestPairs):
+                bestPairs = pairs
+            if len(bestPairs) >= minAgree:
+                break
+        if len(bestPairs) < 3:
+            raise RuntimeError('no field solution found, best had %i stars agreeing' % len(bestPairs))
+        return fitTransform(self.coordList[bestPairs[:,0]], coordList[bestPairs[:,1]], self.allowFlip)
+
+    def agreeingStars(self, transform, coordList):
+        """Return n x 2 indices of (reference, coordList) star pairs that agree 
+        with transform: the nearest star in coordList to each transformed reference star, 
+        if it's within matchTol
+        """
+        mapped = transform.apply(self.coordList)
+        dist = numpy.sqrt(numpy.sum((mapped[:,None,:] - coordList[None,:,:])**2, 2))
+        nearest = numpy.argmin(dist, 1)
+        refInds = numpy.flatnonzero(dist[numpy.arange(len(mapped)), nearest] < self.matchTol)
+        return numpy.column_stack((refInds, nearest[refInds]))
@@ -1,9 +1,12 @@
 """visualization tools
+
+matplotlib is imported inside the functions that use it, so importing this module 
+doesn't start a plotting backend
 """
-import matplotlib.pyplot as plt
-import matplotlib.cm as cm
 import numpy
 import itertools
+import os
+import multiprocessing
 
 # axNew = fig.add_subplot(111)
 
@@ -12,6 +15,7 @@ def apPhotExtraction(photObj):
     inputs:
     photObj: a phot.photObj object
     """
+    import matplotlib.pyplot as plt
     #img = plt.imshow(photObj._img, interpolation='none', origin='upper')
 
     psfMask = numpy.zeros(photObj._img.shape)
@@ -38,6 +42,7 @@ def skyHist(photObj):
     inputs:
     photObj: a phot.photObj object
     """
+    import matplotlib.pyplot as plt
     plt.hist(photObj._sky)
     plt.show()
 
@@ -46,76 +51,58 @@ def countsHist(fig, photObj):
     inputs:
     photObj: a phot.photObj object
     """
+    import matplotlib.pyplot as plt
     plt.hist(photObj._counts)
     plt.show()
 
 
-def plotDiff(ax, diffPhotObjs):
+def plotDiff(ax, photTable):
     """Plot differential photometry for target
     input:
     ax: from matplotlib.pyplot.figure.add_subplot(...)
-    a list of DiffPhotObjs
+    photTable: a phot.PhotTable, eg Driver.results
     """
-    time = []
-    timeseries = []
-    for obj in diffPhotObjs:
-        time.append(obj.img.dateObs)
-        timeseries.append(obj.diffCounts)
-    time = numpy.asarray(time)
-    timeseries = numpy.asarray(timeseries)
-    m = numpy.median(timeseries)
+    timeseries = photTable.diffCounts
+    m = numpy.median(timeseries, axis=0) # per aperture if there are several
     timeseries = timeseries / m # normalize so lightcurve sits around 1
     plotLightCurve(ax,
-        time, timeseries,
+        photTable.times, timeseries,
         title = 'Target Differential Light Curve',
         xlabel = 'Date of Observation',
         ylabel = '% Variation Flux'
         )
 
-def plotTarg(ax, diffPhotObjs):
+def plotTarg(ax, photTable):
     """Plot differential photometry for target
     input:
     ax: from matplotlib.pyplot.figure.add_subplot(...)
-    a list of DiffPhotObjs
+    photTable: a phot.PhotTable, eg Driver.results
     """
-    time = []
-    timeseries = []
-    for obj in diffPhotObjs:
-        time.append(obj.img.dateObs)
-        timeseries.append(obj.targCounts)
-    time = numpy.asarray(time)
-    timeseries = numpy.asarray(timeseries)
     plotLightCurve(ax,
-        time, timeseries,
+        photTable.times, photTable.targCounts,
         title = 'Target Light Curve',
         xlabel = 'Date of Observation',
         ylabel = 'Counts'
         )
 
-def plotComp(ax, diffPhotObjs):
+def plotComp(ax, photTable):
     """Plot differential photometry for target
     input:
     ax: from matplotlib.pyplot.figure.add_subplot(...)
-    a list of DiffPhotObjs
+    photTable: a phot.PhotTable, eg Driver.results
     """
-    time = []
-    timeseries = []
-    for obj in diffPhotObjs:
-        time.append(obj.img.dateObs)
-        timeseries.append(obj.compCounts)
-    time = numpy.asarray(time)
-    timeseries = numpy.asarray(timeseries) #2D
+    import matplotlib.pyplot as plt
+    time = photTable.times
     # permute timeseries to iterate over object rather than time step
-    timeseries = timeseries.T
-    print 'time.shape', time.shape
+    timeseries = numpy.rollaxis(photTable.compCounts, 1)
     for num, obj in enumerate(timeseries):
-        print 'timeseries.shape', obj.shape
         plt.plot(time, obj, '.', label = 'Comparison %i' % num)
     plt.legend()
 
 def plotLightCurve(ax, time, timeseries, title=None, xlabel=None, ylabel=None):
     """plot a light curve
     """
+    import matplotlib.pyplot as plt
     ax.plot(time, timeseries, '.')
     if xlabel:
         plt.xlabel(xlabel)
@@ -129,22 +116,52 @@ def showField(ax, imgData, targetCoords, compCoords):
     """
     circRad = 5
     #norm = colors.Normalize()
-    ax.imshow(scaleImg(imgData), cmap=cm.Greys_r)
-    if targetCoords != None:
+    ax.imshow(scaleImg(imgData), cmap='Greys_r')
+    if targetCoords is not None:
         targX, targY = circle(numpy.asarray(targetCoords) - 0.5, circRad)
         ax.plot(targX, targY, 'r')
-    if compCoords != None:
+    if compCoords is not None:
         for num, comp in enumerate(compCoords):
             compX, compY = circle(numpy.asarray(comp) - 0.5, circRad)
             ax.plot(compX, compY, 'g')
-            plt.text(comp[0]+2, comp[1]+2, '%i'%(num+1))
+            ax.text(comp[0]+2, comp[1]+2, '%i'%(num+1))
 #     plt.xlim((0,imgData.shape[0]))
 #     plt.ylim((0,imgData.shape[1]))
-    plt.draw()
+    ax.figure.canvas.draw()
 
 def showFieldSolution(ax, fieldSolution):
     showField(ax, fieldSolution.img.data, fieldSolution.targetCoords, fieldSolution.compCoords)
 
+def renderFallbacks(fallbacks, outDir):
+    """Draw each flow.Fallback (an image that needed hashing while crunching) 
+    to outDir/fallback_<image name>.png, with the expected target and comparison 
+    positions circled.  Uses the Agg backend directly, so works without a display 
+    and never touches pyplot state.  Images are shown uncalibrated.
+    """
+    import pyfits
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    outFiles = []
+    for fallback in fallbacks:
+        fig = Figure()
+        FigureCanvasAgg(fig)
+        ax = fig.add_subplot(111)
+        showField(ax, numpy.asarray(pyfits.getdata(fallback.path), dtype=float), fallback.targPos, fallback.compPos)
+        status = 'offset: %s' % fallback.offset if fallback.transform is not None else 'hash failed'
+        ax.set_title('%s %s' % (os.path.basename(fallback.path), status), fontsize='small')
+        outFile = os.path.join(outDir, 'fallback_%s.png' % os.path.splitext(os.path.basename(fallback.path))[0])
+        fig.savefig(outFile)
+        outFiles.append(outFile)
+    return outFiles
+
+def renderFallbacksBackground(fallbacks, outDir):
+    """renderFallbacks in a separate process, returns the started 
+    multiprocessing.Process, join it to wait for the figures
+    """
+    proc = multiprocessing.Process(target = renderFallbacks, args = (fallbacks, outDir))
+    proc.start()
+    return proc
+
 def circle(xyCtr, rad):
     """Takes a center and a radius, returns x and y for plotting
     """
@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+"""Pipeline benchmark on a synthetic star field (see synthField.py).
+
+Times each stage of the reduction: reading headers (imgLister), making masters
+and calibrating (Calibrator), finding stars (Cruncher.findSources), building a
+TriangleHash and solving a flipped field with it (hashItOut), single star
+photometry (ApPhot.fuckinDoIt) and a full Cruncher.crunchLoop, serially and in
+a process pool of --procs processes.  Reports
+throughput, peak memory (maxrss) after each stage and photometric accuracy against
+the injected fluxes.
+
+Accuracy must always reach fixed limits (MaxErrors, and every other check must 
+pass), the benchmark fails otherwise, baseline or not.  Stage times and accuracy 
+are also checked against a stored baseline (benchmarkBaseline.json next to this 
+file, made with --save) if there is one; the benchmark fails if a stage is more 
+than --tolerance slower, or accuracy is worse, than the baseline.
+
+usage: python benchmark.py [--frames N] [--size N] [--stars N] [--sky method] [--procs N] [--save] [--tolerance F] [--json path]
+"""
+import os
+import sys
+import time
+import json
+import shutil
+import resource
+import tempfile
+import optparse
+import numpy
+
+import synthField
+
+BaselinePath = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarkBaseline.json')
+
+# largest accuracy errors allowed on any run, the other accuracy checks (fractions 
+# of frames measured, True/False comparisons) must all be 1/True
+MaxErrors = {
+    'apertureFluxError': 0.05,
+    'diffRatioError': 0.01,
+    }
+
+def setup():
+    """make the package importable without runTests.py
+    """
+    testDir = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, os.path.join(os.path.dirname(testDir), 'python'))
+
+def maxrss():
+    """peak resident memory of this process so far, MB
+    """
+    scale = 1. if sys.platform == 'darwin' else 1024. # bytes on mac, KB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 2**20
+
+class Stages(object):
+    """collects the time, item count and peak memory of each stage
+    """
+    def __init__(self):
+        self.stages = []
+
+    def run(self, name, func, nItems = 1, unit = 'frames'):
+        """time func(), which processes nItems of unit, returns its output
+        """
+        t0 = time.time()
+        out = func()
+        seconds = time.time() - t0
+        self.stages.append({'name': name, 'seconds': seconds, 'nItems': nItems,
+            'unit': unit, 'rate': nItems / seconds if seconds else float('inf'), 'maxrss': maxrss()})
+        print '%-22s %9.4f s %10.1f %s/s  maxrss %7.1f MB' % (name, seconds,
+            self.stages[-1]['rate'], unit, self.stages[-1]['maxrss'])
+        return out
+
+def benchmark(opts):
+    import PyGuide
+    import autoPhot
+    from autoPhot import img, phot, flow, config, triangleHash
+
+    workDir = tempfile.mkdtemp(prefix = 'autoPhotBench')
+    try:
+        # meridian flip halfway through, so both crunchLoop and hashItOut see it
+        series = synthField.makeSeries(workDir, nFrames = opts.frames, shape = (opts.size, opts.size),
+            nStars = opts.stars, fwhm = opts.fwhm, psf = opts.psf, flipAt = opts.frames // 2, seed = opts.seed)
+        camera = config.flareCam
+        photConfig = config.PhotConfig(backend = opts.backend, skyMethod = opts.sky)
+        stages = Stages()
+        nFrames = len(series['objFiles'])
+
+        objList = stages.run('imgLister', lambda: img.imgLister(series['objFiles'], 'light', camera), nFrames)
+        biasList = img.imgLister(series['biasFiles'], 'bias', camera)
+        flatList = img.imgLister(series['flatFiles'], 'flat', camera)
+        calibrator = stages.run('Calibrator masters', lambda: img.Calibrator(biasList, flatList,
+            cameraConst = camera), len(biasList) + len(flatList))
+        for image in objList:
+            image.setCalibrator(calibrator)
+        frames = stages.run('Calibrator calibrate', lambda: [image.data for image in objList], nFrames)
+
+        ccdInfo = PyGuide.CCDInfo(0, camera.readNoise, camera.ccdGain)
+        cruncher = flow.Cruncher(flow.FieldSolution(), ccdInfo, headless = True)
+        sources = stages.run('findSources', lambda: [cruncher.findSources(data) for data in frames], nFrames)
+        hash = stages.run('TriangleHash build', lambda: triangleHash.TriangleHash(sources[0]), len(sources[0]), 'stars')
+        flipped = sources[-1]
+        transform = stages.run('hashItOut', lambda: hash.hashItOut(flipped), 1, 'solves')
+
+        # single star photometry on the first frame, at the injected positions
+        apPhot = phot.BACKENDS[opts.backend](frames[0], photConfig.inrad, photConfig.skyann,
+            gridDense = photConfig.res, splineOrder = photConfig.spline, skyMethod = photConfig.skyMethod)
+        border = photConfig.skyann[1] + 2
+        xy = series['xy'][0]
+        inside = numpy.all((xy > border) & (xy < opts.size - 1 - border), axis = 1)
+        photObjs = stages.run('ApPhot.fuckinDoIt', lambda: [apPhot.fuckinDoIt(center) for center in xy[inside]],
+            int(inside.sum()), 'stars')
+
+        # full crunch of the night, target is the brightest star, comparisons the next few
+        fieldSolution = flow.FieldSolution(
+            targetCoords = xy[0] + 0.5, compCoords = list(xy[1:1 + opts.comps] + 0.5),
+            img = objList[0], hash = hash)
+        cruncher = flow.Cruncher(fieldSolution, ccdInfo, headless = True)
+        crunchConfig = config.Config(camera, photConfig, [])
+        results = stages.run('crunchLoop', lambda: cruncher.crunchLoop(objList, crunchConfig), nFrames)
+        # the same crunch in a process pool, everything handed to the workers must pickle,
+        # and it must give exactly the serial photometry
+        cruncher = flow.Cruncher(fieldSolution, ccdInfo, headless = True)
+        poolResults = stages.run('crunchLoop nProc=%i' % opts.procs, 
+            lambda: cruncher.crunchLoop(objList, crunchConfig, nProc = opts.procs), nFrames)
+        # a drifting night with no flip, calibrated, pooled and serial must agree here too
+        driftDir = os.path.join(workDir, 'drift')
+        os.mkdir(driftDir)
+        drift = synthField.makeSeries(driftDir, nFrames = opts.frames, shape = (opts.size, opts.size),
+            nStars = opts.stars, fwhm = opts.fwhm, psf = opts.psf, seed = opts.seed + 1)
+        driftList = img.imgLister(drift['objFiles'], 'light', camera)
+        driftCalibrator = img.Calibrator(img.imgLister(drift['biasFiles'], 'bias', camera),
+            img.imgLister(drift['flatFiles'], 'flat', camera), cameraConst = camera)
+        for image in driftList:
+            image.setCalibrator(driftCalibrator)
+        driftXY = drift['xy'][0]
+        driftSolution = flow.FieldSolution(
+            targetCoords = driftXY[0] + 0.5, compCoords = list(driftXY[1:1 + opts.comps] + 0.5),
+            img = driftList[0], hash = triangleHash.TriangleHash(cruncher.findSources(driftList[0].data)))
+        driftResults = flow.Cruncher(driftSolution, ccdInfo, headless = True).crunchLoop(driftList, crunchConfig)
+        driftPool = flow.Cruncher(driftSolution, ccdInfo, headless = True).crunchLoop(driftList, 
+            crunchConfig, nProc = opts.procs)
+        # spline smoothed photometry reading only windows around the stars, against full frames
+        splineResults = {}
+        for frameAccess in ['full', 'window']:
+            splineConfig = config.Config(camera, config.PhotConfig(backend = opts.backend, spline = 3,
+                skyMethod = opts.sky), [], frameAccess = frameAccess)
+            cruncher = flow.Cruncher(fieldSolution, ccdInfo, headless = True)
+            splineResults[frameAccess] = stages.run('crunchLoop spline %s' % frameAccess, 
+                lambda: cruncher.crunchLoop(objList, splineConfig), nFrames)
+
+        # accuracy
+        injected = series['flux'][0][inside]
+        measured = numpy.asarray([photObj.counts for photObj in photObjs])
+        # fraction of a gaussian star's light inside the aperture
+        sigma = opts.fwhm / (2 * numpy.sqrt(2 * numpy.log(2)))
+        enclosed = 1 - numpy.exp(-photConfig.inrad**2 / (2 * sigma**2)) if opts.psf == 'gaussian' else 1.
+        bright = injected > numpy.median(injected)
+        accuracy = {
+            'apertureFluxError': float(numpy.median(numpy.abs(measured[bright] / (injected[bright] * enclosed) - 1))),
+            'framesMeasured': len(results) / float(nFrames),
+            'poolMatchesSerial': bool(list(poolResults.path) == list(results.path) and
+                numpy.allclose(poolResults.counts, results.counts, rtol = 0, atol = 0, equal_nan = True)),
+            'poolMatchesSerialDrift': bool(len(driftResults) == nFrames and
+                list(driftPool.path) == list(driftResults.path) and
+                numpy.allclose(driftPool.counts, driftResults.counts, rtol = 0, atol = 0, equal_nan = True)),
+            # window centroids differ very slightly from full frame ones
+            'splineWindowMatchesFull': bool(len(splineResults['window']) == nFrames and
+                list(splineResults['window'].path) == list(splineResults['full'].path) and
+                numpy.allclose(splineResults['window'].counts, splineResults['full'].counts, 
+                    rtol = 1e-3, equal_nan = True)),
+            }
+        nStars = 1 + opts.comps
+        injectedRatio = series['flux'][:, 1:nStars] / series['flux'][:, :1]
+        measuredRatio = results.counts[:, 1:] / results.counts[:, :1]
+        frameNums = [series['objFiles'].index(path) for path in results.path]
+        if len(frameNums):
+            accuracy['diffRatioError'] = float(numpy.nanmedian(numpy.abs(measuredRatio / injectedRatio[frameNums] - 1)))
+        truthRotation = series['rotation'][-1]
+        accuracy['hashRotationOK'] = bool(numpy.allclose(transform.rotation, truthRotation, atol = 0.05))
+        for name, value in sorted(accuracy.items()):
+            print '%-22s %s' % (name, value)
+        return {'stages': stages.stages, 'accuracy': accuracy,
+            'settings': dict((key, getattr(opts, key)) for key in ['frames', 'size', 'stars', 'comps',
+                'fwhm', 'psf', 'backend', 'sky', 'procs', 'seed'])}
+    finally:
+        shutil.rmtree(workDir, ignore_errors = True)
+
+def check(report):
+    """return a list of accuracy checks report fails, baseline or not
+    """
+    failures = []
+    for name, value in sorted(report['accuracy'].items()):
+        if name.endswith('Error'):
+            # written so nan fails too
+            ok = value <= MaxErrors.get(name, numpy.inf)
+        else:
+            ok = value >= 1
+        if not ok:
+            failures.append('%s is %s' % (name, value))
+    for name in MaxErrors:
+        if name not in report['accuracy']:
+            failures.append('%s was not measured' % name)
+    return failures
+
+def compare(report, baseline, tolerance):
+    """return a list of regressions of report against baseline
+    """
+    failures = []
+    if report['settings'] != baseline['settings']:
+        print 'warning: benchmark settings differ from the baseline\'s %s' % baseline['settings']
+    baseStages = dict((stage['name'], stage) for stage in baseline['stages'])
+    for stage in report['stages']:
+        base = baseStages.get(stage['name'])
+        if base and stage['seconds'] > base['seconds'] * (1 + tolerance):
+            failures.append('%s took %.4f s, baseline %.4f s' % (stage['name'], stage['seconds'], base['seconds']))
+    for name, value in report['accuracy'].items():
+        base = baseline['accuracy'].get(name)
+        if base is None:
+            continue
+        if name.endswith('Error'):
+            worse = value > max(base * (1 + tolerance), base + 1e-3)
+        else:
+            worse = value < base
+        if worse:
+            failures.append('%s is %s, baseline %s' % (name, value, base))
+    return failures
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage = __doc__.strip().split('\n')[-1])
+    parser.add_option('--frames', type = 'int', default = 20)
+    parser.add_option('--size', type = 'int', default = 512)
+    parser.add_option('--stars', type = 'int', default = 60)
+    parser.add_option('--comps', type = 'int', default = 3)
+    parser.add_option('--fwhm', type = 'float', default = 2.5)
+    parser.add_option('--psf', default = 'gaussian')
+    parser.add_option('--backend', default = 'dense')
+    parser.add_option('--sky', default = 'median', help = 'sky estimator, see phot.skyLevel')
+    parser.add_option('--procs', type = 'int', default = 2, help = 'processes for the pooled crunchLoop')
+    parser.add_option('--seed', type = 'int', default = 0)
+    parser.add_option('--save', action = 'store_true', help = 'store this run as the baseline')
+    parser.add_option('--tolerance', type = 'float', default = 0.5, help = 'allowed fractional slowdown')
+    parser.add_option('--json', help = 'also write the report to this file')
+    opts, args = parser.parse_args()
+    setup()
+    report = benchmark(opts)
+    if opts.json:
+        with open(opts.json, 'w') as f:
+            json.dump(report, f, indent = 1)
+    failures = check(report)
+    if opts.save:
+        if failures:
+            print 'not saving a baseline that fails the accuracy limits'
+        else:
+            with open(BaselinePath, 'w') as f:
+                json.dump(report, f, indent = 1)
+            print 'saved baseline %s' % BaselinePath
+    elif os.path.exists(BaselinePath):
+        with open(BaselinePath) as f:
+            failures += compare(report, json.load(f), opts.tolerance)
+    else:
+        print 'no baseline stored, run with --save to make one, only accuracy limits are checked'
+    for failure in failures:
+        print 'REGRESSION: %s' % failure
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+"""Import time benchmark.
+
+Times importing the autoPhot package and the submodules worker processes use, each
+in a fresh interpreter, and checks that none of them drag in heavy modules they
+don't need (plotting especially).  Also checks that every public name the lazy 
+package lists (autoPhot.__all__, from its _exports table) is really defined by its 
+submodule.  Exits with status 1 if either check fails.
+
+usage: python importTime.py [nRepeat]
+"""
+import os
+import sys
+import subprocess
+
+# what each import statement may not load
+Forbidden = {
+    'import autoPhot': ['matplotlib', 'scipy', 'pyfits', 'PyGuide'],
+    'import autoPhot.phot': ['matplotlib', 'scipy', 'pyfits', 'PyGuide'],
+    'import autoPhot.triangleHash': ['matplotlib', 'scipy', 'pyfits', 'PyGuide'],
+    'import autoPhot.img': ['matplotlib', 'scipy', 'PyGuide'],
+    'import autoPhot.flow': ['matplotlib', 'scipy'],
+}
+
+Script = """
+import sys, time
+t0 = time.time()
+%s
+t1 = time.time()
+print t1 - t0
+print ' '.join(sorted(set(name.split('.')[0] for name in sys.modules)))
+"""
+
+def timeImport(statement):
+    """run statement in a new interpreter, return (seconds, set of top level modules loaded)
+    """
+    out = subprocess.check_output([sys.executable, '-c', Script % statement], env=os.environ)
+    seconds, modules = out.strip().split('\n')[-2:]
+    return float(seconds), set(modules.split())
+
+ExportScript = """
+import autoPhot
+for name in autoPhot.__all__:
+    try:
+        getattr(autoPhot, name)
+    except AttributeError:
+        print name
+"""
+
+def missingExports():
+    """names in autoPhot.__all__ their submodule doesn't define, looked up in a new 
+    interpreter
+    """
+    out = subprocess.check_output([sys.executable, '-c', ExportScript], env=os.environ)
+    return out.split()
+
+def pythonPath():
+    """the python directory of this package, so the benchmark runs without runTests.py too
+    """
+    testDir = os.path.dirname(os.path.abspath(__file__))
+    return os.path.join(os.path.dirname(testDir), 'python')
+
+if __name__ == '__main__':
+    nRepeat = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    os.environ['PYTHONPATH'] = pythonPath() + os.pathsep + os.environ.get('PYTHONPATH', '')
+    failed = False
+    for statement in sorted(Forbidden):
+        try:
+            results = [timeImport(statement) for i in range(nRepeat)]
+        except subprocess.CalledProcessError as e:
+            print '%-32s failed: %s' % (statement, e)
+            failed = True
+            continue
+        best = min(seconds for seconds, modules in results)
+        loaded = [name for name in Forbidden[statement] if name in results[0][1]]
+        print '%-32s %7.1f ms  %s' % (statement, best*1000.,
+            'loaded: ' + ', '.join(loaded) if loaded else 'ok')
+        failed = failed or bool(loaded)
+    missing = missingExports()
+    print '%-32s %s' % ('autoPhot.__all__', 'missing: ' + ', '.join(missing) if missing else 'ok')
+    failed = failed or bool(missing)
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+"""Synthetic star field images, for benchmarks and tests.
+
+makeSeries writes a night of object frames (plus bias and flat frames) of a
+random star field, with the field drifting a little every frame and optionally
+a meridian flip (180 degree rotation about the image center) partway through.
+The injected star positions and fluxes are returned, so measured photometry can
+be checked against them.
+
+Positions are array coordinates: pixel [row, col] is centered at x = col, y = row.
+PyGuide centroids are 0.5 more than this.
+
+usage: python synthField.py [outDir]   (without outDir the frames are written to a 
+temporary directory, which is removed again)
+"""
+import os
+import sys
+import datetime
+import numpy
+import pyfits
+from scipy.special import erf
+
+DATEFORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+def makeStars(shape = (512, 512), nStars = 50, fluxRange = (2e3, 2e5), border = 20, seed = 0):
+    """random star positions and fluxes (total counts per frame)
+    returns n x 2 array of xy positions, n fluxes (brightest first)
+    """
+    rng = numpy.random.RandomState(seed)
+    xy = numpy.column_stack([
+        rng.uniform(border, shape[1] - border, nStars),
+        rng.uniform(border, shape[0] - border, nStars),
+        ])
+    # a power law, many more faint stars than bright ones
+    logFlux = numpy.log10(fluxRange)
+    flux = 10**(logFlux[0] + (logFlux[1] - logFlux[0]) * rng.power(0.5, nStars))
+    order = numpy.argsort(flux)[::-1]
+    return xy[order], flux[order]
+
+def starImage(shape, xy, flux, fwhm = 2.5, psf = 'gaussian', beta = 3., stampRad = None):
+    """an image with a star of total counts flux at each xy position
+    psf: 'gaussian' (integrated exactly over each pixel) or 'moffat' (with parameter
+        beta, sampled 5x5 in each pixel and normalized over its stamp)
+    """
+    data = numpy.zeros(shape)
+    if stampRad is None:
+        stampRad = int(numpy.ceil(4 * fwhm))
+    sigma = fwhm / (2 * numpy.sqrt(2 * numpy.log(2)))
+    alpha = fwhm / (2 * numpy.sqrt(2**(1. / beta) - 1))
+    for (x, y), starFlux in zip(xy, flux):
+        x0, y0 = int(round(x)), int(round(y))
+        cols = numpy.arange(max(x0 - stampRad, 0), min(x0 + stampRad + 1, shape[1]))
+        rows = numpy.arange(max(y0 - stampRad, 0), min(y0 + stampRad + 1, shape[0]))
+        if not len(cols) or not len(rows):
+            continue
+        if psf == 'gaussian':
+            def integral(edges, center):
+                cdf = erf((edges - center) / (numpy.sqrt(2) * sigma))
+                return (cdf[1:] - cdf[:-1]) / 2.
+            stamp = numpy.outer(integral(numpy.append(rows - 0.5, rows[-1] + 0.5), y),
+                integral(numpy.append(cols - 0.5, cols[-1] + 0.5), x))
+        elif psf == 'moffat':
+            sub = (numpy.arange(5) - 2) / 5.
+            yy = (rows[:,None] + sub[None,:]).ravel()[:,None] - y
+            xx = (cols[:,None] + sub[None,:]).ravel()[None,:] - x
+            stamp = (1 + (xx**2 + yy**2) / alpha**2)**-beta
+            stamp = stamp.reshape(len(rows), 5, len(cols), 5).sum(axis=(1, 3))
+            stamp /= stamp.sum()
+        else:
+            raise RuntimeError('psf must be "gaussian" or "moffat", got %s' % psf)
+        data[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1] += starFlux * stamp
+    return data
+
+def noisy(data, rng, gain = 1.5, readNoise = 11.):
+    """add photon noise (data in ADU, gain in e-/ADU) and read noise (e-)
+    """
+    return rng.poisson(numpy.clip(data, 0, None) * gain) / gain + rng.normal(0, readNoise / gain, data.shape)
+
+def writeFrame(path, data, dateObs, exptime, filter = 'g'):
+    header = pyfits.Header()
+    header['DATE-OBS'] = dateObs.strftime(DATEFORMAT)[:-3]
+    header['EXPTIME'] = exptime
+    header['FILTER'] = filter
+    pyfits.writeto(path, numpy.round(data).clip(0, 65535).astype(numpy.uint16), header, clobber = True)
+
+def fieldTransform(frameNum, shape, drift, flipAt):
+    """rotation and translation of frame frameNum from the first frame,
+    xyFrame = rotation . xyFirst + translation
+    """
+    rotation = numpy.eye(2)
+    translation = numpy.asarray(drift, dtype=float) * frameNum
+    if flipAt is not None and frameNum >= flipAt:
+        # meridian flip, rotate 180 degrees about the image center
+        center = (numpy.array(shape[::-1]) - 1) / 2.
+        rotation = -rotation
+        translation = 2 * center - translation
+    return rotation, translation
+
+def makeSeries(outDir, nFrames = 20, shape = (512, 512), nStars = 50, fwhm = 2.5, psf = 'gaussian',
+        drift = (0.3, -0.2), flipAt = None, exptime = 10., sky = 100., biasLevel = 300.,
+        gain = 1.5, readNoise = 11., nBias = 5, nFlat = 5, variable = None, seed = 0):
+    """Write a series of synthetic frames to outDir
+    inputs:
+    nFrames: number of object frames
+    shape: image shape
+    nStars: number of stars
+    fwhm: psf full width half max, pixels
+    psf: 'gaussian' or 'moffat'
+    drift: xy pixels the field moves each frame
+    flipAt: frame number of a meridian flip, or None
+    exptime: exposure time (s)
+    sky: sky level, counts per pixel per frame
+    biasLevel: bias level in every frame
+    gain, readNoise: e-/ADU and e-
+    nBias, nFlat: number of bias and flat frames, 0 for none
+    variable: per frame flux multiplier of star 0 (eg a flare), or None for constant
+    seed: random seed
+
+    returns a dict:
+    objFiles, biasFiles, flatFiles: lists of paths written
+    xy: nFrames x nStars x 2 injected positions (array coordinates)
+    flux: nFrames x nStars injected total counts
+    rotation, translation: nFrames x 2 x 2, nFrames x 2 field transforms from the first frame
+    """
+    if not os.path.exists(outDir):
+        os.makedirs(outDir)
+    rng = numpy.random.RandomState(seed)
+    xy0, flux0 = makeStars(shape, nStars, seed = seed)
+    # a gently varying flat field
+    yy, xx = numpy.mgrid[0:shape[0], 0:shape[1]] / float(max(shape))
+    flat = 1 + 0.05 * numpy.sin(3 * xx + 1) * numpy.cos(2 * yy) + rng.normal(0, 0.005, shape)
+    start = datetime.datetime(2012, 5, 20, 3)
+    out = {'objFiles': [], 'biasFiles': [], 'flatFiles': [], 'xy': [], 'flux': [],
+        'rotation': [], 'translation': []}
+    for num in range(nBias):
+        path = os.path.join(outDir, 'bias%03i.fits' % num)
+        writeFrame(path, biasLevel + noisy(numpy.zeros(shape), rng, gain, readNoise),
+            start - datetime.timedelta(hours = 1, seconds = num), 0.)
+        out['biasFiles'].append(path)
+    for num in range(nFlat):
+        path = os.path.join(outDir, 'flat%03i.fits' % num)
+        writeFrame(path, biasLevel + noisy(20000. * flat, rng, gain, readNoise),
+            start - datetime.timedelta(minutes = 30, seconds = num), 1.)
+        out['flatFiles'].append(path)
+    for num in range(nFrames):
+        rotation, translation = fieldTransform(num, shape, drift, flipAt)
+        xy = numpy.dot(xy0, rotation.T) + translation
+        flux = flux0.copy()
+        if variable is not None:
+            flux[0] *= variable[num]
+        data = biasLevel + noisy((starImage(shape, xy, flux, fwhm, psf) + sky) * flat, rng, gain, readNoise)
+        path = os.path.join(outDir, 'obj%04i.fits' % num)
+        writeFrame(path, data, start + datetime.timedelta(seconds = num * (exptime + 2)), exptime)
+        out['objFiles'].append(path)
+        out['xy'].append(xy)
+        out['flux'].append(flux)
+        out['rotation'].append(rotation)
+        out['translation'].append(translation)
+    for key in ['xy', 'flux', 'rotation', 'translation']:
+        out[key] = numpy.asarray(out[key])
+    return out
+
+if __name__ == '__main__':
+    import tempfile
+    import shutil
+    # a directory given on the command line is kept, a temporary one is removed
+    keep = len(sys.argv) > 1
+    outDir = sys.argv[1] if keep else tempfile.mkdtemp(prefix = 'synthField')
+    try:
+        series = makeSeries(outDir, nFrames = 5, flipAt = 3)
+        print 'wrote %i object, %i bias and %i flat frames to %s' % (len(series['objFiles']),
+            len(series['biasFiles']), len(series['flatFiles']), outDir)
+    finally:
+        if not keep:
+            shutil.rmtree(outDir, ignore_errors = True)
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+"""Small deterministic checks of the pieces benchmark.py only exercises as a whole:
+row writers reading back what they wrote, TriangleHash.triangleMatch keeping the
+matches of the original rank ordered search, weightedMedian against a plain median
+of repeated values and ExactApPhot's pixel/circle overlaps against the circle's area.
+
+usage: python unitTests.py [-v]
+"""
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import numpy
+
+def setup():
+    """make the package importable without runTests.py
+    """
+    testDir = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, os.path.join(os.path.dirname(testDir), 'python'))
+
+setup()
+from autoPhot import phot, output, triangleHash
+
+def makeTable(nStars, nRows, radii=None):
+    """a phot.PhotTable of made up rows
+    """
+    rng = numpy.random.RandomState(1)
+    table = phot.PhotTable(nStars, nRows, radii)
+    countsShape = (nStars,) if table.radii is None else (nStars, len(table.radii))
+    for num in range(nRows):
+        table.appendRow(dict(
+            path = 'img%04i.fits' % num,
+            dateObs = numpy.datetime64('2012-05-20T03:%02i:%02i.250000' % (num, num), 'us'),
+            exptime = 10. + num,
+            counts = rng.uniform(1e3, 1e5, countsShape),
+            sky = rng.uniform(90, 110, nStars),
+            centroids = rng.uniform(0, 512, (nStars, 2)),
+            offset = rng.normal(0, 3, 2),
+            rotation = numpy.eye(2),
+            flags = num % 4,
+            ))
+    return table
+
+class WriterTest(unittest.TestCase):
+    """every output.RowWriter format reads back the rows written, written a few at
+    a time as crunchLoop does
+    """
+    def setUp(self):
+        self.outDir = tempfile.mkdtemp(prefix = 'autoPhotTest')
+
+    def tearDown(self):
+        shutil.rmtree(self.outDir, ignore_errors = True)
+
+    def writeRows(self, fmt, table):
+        """write table with a new fmt writer in pieces, return (path, expected rows)
+        """
+        path = os.path.join(self.outDir, 'rows.' + fmt)
+        writer = output.WRITERS[fmt](path, table.nStars, table.radii)
+        for start, stop in [(0, 1), (1, 1), (1, 4), (4, len(table))]:
+            writer.write(table, start, stop)
+        writer.close()
+        return path, writer.rows(table, 0, len(table))
+
+    def checkRows(self, rows, expected):
+        self.assertEqual(len(rows), len(expected))
+        self.assertEqual(list(rows['DATE-OBS']), list(expected['DATE-OBS']))
+        for name in ['EXPTIME', 'FLUX', 'SKY', 'OFFSET', 'FLAGS']:
+            numpy.testing.assert_array_equal(rows[name], expected[name], err_msg = name)
+
+    def testNpy(self):
+        for radii in [5, [4, 6, 8]]:
+            path, expected = self.writeRows('npy', makeTable(3, 7, radii))
+            self.checkRows(numpy.load(path), expected)
+
+    def testFits(self):
+        import pyfits
+        for radii in [5, [4, 6, 8]]:
+            path, expected = self.writeRows('fits', makeTable(3, 7, radii))
+            hdus = pyfits.open(path)
+            rows = hdus[1].data
+            self.assertEqual(hdus[1].header['NAXIS2'], len(expected))
+            self.assertEqual(len(rows), len(expected))
+            self.assertEqual([str(date) for date in rows['DATE-OBS']], list(expected['DATE-OBS']))
+            for name in ['EXPTIME', 'FLUX', 'SKY', 'OFFSET', 'FLAGS']:
+                numpy.testing.assert_array_equal(numpy.asarray(rows[name]).reshape(expected[name].shape),
+                    expected[name], err_msg = name)
+            hdus.close()
+
+    def testCsv(self):
+        for radii in [5, [4, 6, 8]]:
+            table = makeTable(3, 7, radii)
+            path, expected = self.writeRows('csv', table)
+            with open(path) as f:
+                lines = f.read().splitlines()
+            header = lines[0].split(', ')
+            self.assertEqual(len(lines), 1 + len(table))
+            for line, row in zip(lines[1:], expected):
+                values = line.split(', ')
+                self.assertEqual(len(values), len(header))
+                self.assertEqual(values[0], row['DATE-OBS'])
+                numbers = numpy.asarray(values[1:], dtype = float)
+                written = numpy.concatenate([[row['EXPTIME']], row['FLUX'].ravel(), row['SKY'],
+                    row['OFFSET'], [row['FLAGS']]])
+                # written with %f, to a millionth
+                numpy.testing.assert_allclose(numbers, written, rtol = 0, atol = 5e-7)
+
+def oldTriangleMatch(triSpace1, triSpace2):
+    """triangleMatch as it was first written, a search through every pair of
+    triangles in rank order, stopping for each triSpace1 triangle once there are
+    more than 10 matches in all
+    """
+    tol = 0.02
+    potentialMatches = []
+    triSort1 = numpy.argsort(triSpace1[:,0] * triSpace1[:,1])
+    triSort2 = numpy.argsort(triSpace2[:,0] * triSpace2[:,1])
+    for ind1 in triSort1:
+        for ind2 in triSort2:
+            ratio = numpy.abs(1 - (triSpace1[ind1, :] / triSpace2[ind2, :]))
+            if numpy.max(ratio) < tol:
+                potentialMatches.append([ind1, ind2])
+            if len(potentialMatches) > 10:
+                break
+    return numpy.asarray(potentialMatches, dtype = int).reshape(-1, 2)
+
+class TriangleMatchTest(unittest.TestCase):
+    """TriangleHash.triangleMatch finds the same matches, in the same order, as the
+    original pairwise search
+    """
+    def testRandomFields(self):
+        rng = numpy.random.RandomState(0)
+        for nStars in [3, 5, 12, 25]:
+            for nLost in range(3):
+                xy = rng.uniform(0, 500, (nStars, 2))
+                nOther = max(3, nStars - nLost)
+                other = xy[rng.permutation(nStars)][:nOther] + rng.normal(0, 0.3, (nOther, 2)) + [5, -3]
+                hash = triangleHash.TriangleHash(xy)
+                triSpace = hash.triangleSpace(hash.makeTriVerts(other))
+                numpy.testing.assert_array_equal(hash.triangleMatch(hash.triSpace, triSpace),
+                    oldTriangleMatch(hash.triSpace, triSpace), err_msg = '%i stars' % nStars)
+
+    def testGrid(self):
+        # a regular grid has many similar triangles, so many candidates per triangle
+        xy = numpy.array([[x, y] for x in range(0, 60, 10) for y in range(0, 60, 10)], dtype = float)
+        hash = triangleHash.TriangleHash(xy)
+        numpy.testing.assert_array_equal(hash.triangleMatch(hash.triSpace, hash.triSpace),
+            oldTriangleMatch(hash.triSpace, hash.triSpace))
+
+    def testNoTriangles(self):
+        hash = triangleHash.TriangleHash(numpy.random.RandomState(2).uniform(0, 100, (6, 2)))
+        self.assertEqual(hash.triangleMatch(hash.triSpace, hash.triSpace[:0]).shape, (0, 2))
+
+class WeightedMedianTest(unittest.TestCase):
+    """with integer weights weightedMedian is the median of each value repeated
+    weights times
+    """
+    def testRepeatedValues(self):
+        rng = numpy.random.RandomState(3)
+        for nValues in [1, 2, 5, 16, 49]:
+            values = rng.normal(100, 10, (20, nValues))
+            # ties too
+            values[::3] = numpy.round(values[::3] / 5) * 5
+            weights = rng.randint(0, 4, (20, nValues))
+            weights[:,0] += 1 # no empty rows
+            expected = [numpy.median(numpy.repeat(rowValues, rowWeights))
+                for rowValues, rowWeights in zip(values, weights)]
+            numpy.testing.assert_array_equal(phot.weightedMedian(values, weights), expected)
+
+    def testNoWeight(self):
+        self.assertTrue(numpy.all(numpy.isnan(phot.weightedMedian(numpy.ones((2, 3)), numpy.zeros((2, 3))))))
+
+class OverlapTest(unittest.TestCase):
+    """cornerArea and the pixel overlaps ExactApPhot makes from it add up to the
+    area of the circle
+    """
+    def testCornerArea(self):
+        for radius in [0.3, 1., 2.5, 7.]:
+            # a quadrant, a box around the whole circle, and all four quadrants by sign
+            self.assertAlmostEqual(phot.cornerArea(radius, radius, radius), numpy.pi * radius**2 / 4, 12)
+            self.assertAlmostEqual(phot.cornerArea(2 * radius, 3 * radius, radius), numpy.pi * radius**2 / 4, 12)
+            total = sum(phot.cornerArea(x, y, radius) * numpy.sign(x) * numpy.sign(y)
+                for x in [-radius, radius] for y in [-radius, radius])
+            self.assertAlmostEqual(total, numpy.pi * radius**2, 12)
+
+    def testPixelOverlaps(self):
+        apPhot = phot.ExactApPhot(numpy.zeros((64, 64)), [1.5, 4., 6.3], (8, 12))
+        rng = numpy.random.RandomState(4)
+        regionSize = 2 * apPhot._boxSize() + 1
+        centers = apPhot._boxSize() + rng.uniform(-0.5, 0.5, (10, 2))
+        skyWeights, apWeights = apPhot._overlapWeights(centers, regionSize)
+        for radInd, radius in enumerate(apPhot.radii):
+            numpy.testing.assert_allclose(apWeights[:, radInd].sum(axis = (1, 2)), numpy.pi * radius**2, rtol = 1e-12)
+        numpy.testing.assert_allclose(skyWeights.sum(axis = (1, 2)), numpy.pi * (12**2 - 8**2), rtol = 1e-12)
+        # every pixel is at most covered once
+        self.assertTrue(numpy.all((apWeights >= -1e-12) & (apWeights <= 1 + 1e-12)))
+
+if __name__ == '__main__':
+    unittest.main()